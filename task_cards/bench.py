@@ -0,0 +1,325 @@
+"""Benchmarks the stages of building a deck in isolation and writes the
+results as JSON, optionally comparing them to a stored baseline:
+
+    python -m task_cards.bench --output bench.json
+    python -m task_cards.bench --baseline bench.json
+
+Stages whose external tools are missing (pdflatex, poppler) are reported
+as skipped. The log of pdflatex goes to stderr. Everything runs in a
+temporary working directory so that the benchmarks do not touch out/ or
+the caches.
+"""
+import argparse
+import task_cards.tasks.all as tasks_all
+import task_cards.tasks.task as task
+import task_cards.utils.tex as tex
+import io
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import typing
+
+BORDER_IMG = os.path.abspath(os.path.join('img', 'border_1.jpg'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks each stage of building a deck')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='how many times each stage is timed')
+    parser.add_argument('--cards', type=int, default=200,
+                        help='cards generated per task when timing generate '
+                        + 'and generate_batch')
+    parser.add_argument('--doc-pages', type=int, default=5000,
+                        help='the number of pages for generate_doc_latex')
+    parser.add_argument('--stages', type=str, nargs='+', default=None,
+                        choices=sorted(STAGES),
+                        help='only run these stages')
+    parser.add_argument('--output', type=str, default=None,
+                        help='where to write the results, default stdout')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown relative to the baseline')
+    args = parser.parse_args()
+
+    results = run_(args)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as outfile:
+            outfile.write(text)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+        regressions = compare(baseline, results, args.tolerance)
+        for reg in regressions:
+            print(reg, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+def _measure(fn: typing.Callable[[], typing.Any], repeat: int,
+             ops: int = 1) -> typing.Dict[str, float]:
+    """Times fn repeat times, where each call performs ops operations, and
+    measures the peak memory of a call made before them, see _peak_rss.
+    The memory comes first since the heap the timed calls leave behind
+    would be reused by the measured call and not count towards its peak"""
+    peak = _peak_rss(fn)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    best = min(times)
+    return {
+        'seconds_per_op': best / ops,
+        'ops_per_second': ops / best if best > 0 else float('inf'),
+        'mean_seconds': sum(times) / len(times),
+        'peak_bytes': peak,
+    }
+
+
+def _peak_rss(fn: typing.Callable[[], typing.Any]) -> int:
+    """Returns how far one call of fn raises the peak resident memory of
+    the process, in bytes. Unlike tracemalloc this counts memory allocated
+    outside python, ex: the Agg canvas and PIL images. The call runs in a
+    forked child, whose peak starts at its current size, so the peaks of
+    earlier calls do not hide it"""
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    unit = 1 if sys.platform == 'darwin' else 1024
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            fn()
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write_fd, str((after - before) * unit).encode('ascii'))
+            status = 0
+        finally:
+            os._exit(status)  # skip the cleanup of the parent's state
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as infile:
+        peak = infile.read()
+    _, status = os.waitpid(pid, 0)
+    if status != 0 or not peak:
+        raise RuntimeError('measuring the peak memory failed')
+    return int(peak)
+
+
+def _skipped(reason: str) -> typing.Dict[str, str]:
+    return {'skipped': reason}
+
+
+def bench_generate(args) -> typing.Dict[str, typing.Any]:
+    """Throughput of Task.generate for every task"""
+    res = dict()
+    for info in tasks_all.manifest():
+        try:
+            tsk = info.load()()
+            tsk.generate()  # warm up imports and caches
+        except Exception as exc:  # ex: missing upload.json
+            res[info.name] = _skipped(f'{type(exc).__name__}: {exc}')
+            continue
+        res[info.name] = _measure(
+            lambda: [tsk.generate() for _ in range(args.cards)],
+            args.repeat, args.cards)
+    return res
+
+
+def bench_generate_batch(args) -> typing.Dict[str, typing.Any]:
+    """Throughput of Task.generate_batch for the tasks which override it,
+    to compare against generate"""
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    res = dict()
+    for info in tasks_all.manifest():
+        try:
+            tsk = info.load()()
+            if type(tsk).generate_batch is task.Task.generate_batch:
+                continue  # the same as calling generate
+            tsk.generate_batch(1, rng)  # warm up imports and caches
+        except Exception as exc:  # ex: missing upload.json
+            res[info.name] = _skipped(f'{type(exc).__name__}: {exc}')
+            continue
+        res[info.name] = _measure(
+            lambda: tsk.generate_batch(args.cards, rng), args.repeat,
+            args.cards)
+    return res
+
+
+def bench_create_graph(args) -> typing.Dict[str, typing.Any]:
+    """Latency and peak memory of rendering one graph, each time with a
+    new GraphRenderer so that neither depends on the figures which earlier
+    stages left in the shared renderer"""
+    import numpy as np
+    import task_cards.utils.mpl as umpl
+
+    xs = np.linspace(-5, 5, 100)
+    ys = xs ** 2 - 3
+
+    def render():
+        umpl.GraphRenderer().render(xs, ys, 6, 6, -6, io.BytesIO(),
+                                    format='png')
+    return _measure(render, args.repeat)
+
+
+def bench_generate_doc_latex(args) -> typing.Dict[str, typing.Any]:
+    """Writing a large document from pages that are already generated"""
+    tsk = tasks_all.find_task('PerfectSquaresTask')()
+    writer = io.StringIO()
+    tex.generate_task_page(writer, [tsk.generate() for _ in range(4)])
+    pages = [writer.getvalue()] * args.doc_pages
+
+    def generate():
+        tex.generate_doc_latex(io.StringIO(), {'amsmath'}, dict(), pages)
+    return _measure(generate, args.repeat, args.doc_pages)
+
+
+def _sample_tex(pages: int) -> str:
+    """Writes a document with the given number of pages in out/"""
+    tsk = tasks_all.find_task('PerfectSquaresTask')()
+    page_codes = []
+    for _ in range(pages):
+        writer = io.StringIO()
+        tex.generate_task_page(writer, [tsk.generate() for _ in range(4)])
+        page_codes.append(writer.getvalue())
+    preambles = {
+        'margin': '\\usepackage[margin=0in]{geometry}',
+        'parindent': '\\setlength\\parindent{0pt}'
+    }
+    with open('out/bench.tex', 'w') as outfile:
+        tex.generate_doc_latex(outfile, {'qrcode', 'graphicx', 'amsmath'},
+                               preambles, page_codes)
+    return 'out/bench.tex'
+
+
+def _sample_pdf(pages: int) -> str:
+    """Compiles a document with the given number of pages in out/"""
+    tex.pdflatex(_sample_tex(pages), 'out')
+    return 'out/bench.pdf'
+
+
+def bench_pdflatex(args) -> typing.Dict[str, typing.Any]:
+    """Time to compile a document which is already written, per page"""
+    if shutil.which('pdflatex') is None:
+        return _skipped('pdflatex not found')
+    pages = 10
+    latexfile = _sample_tex(pages)
+    return _measure(lambda: tex.pdflatex(latexfile, 'out'), args.repeat,
+                    pages)
+
+
+def bench_add_borders_to_img(args) -> typing.Dict[str, typing.Any]:
+    """Bordering a single card image"""
+    import PIL.Image
+    import task_cards.utils.borders as borders
+
+    if not os.path.exists(BORDER_IMG):
+        return _skipped(f'{BORDER_IMG} not found')
+    card = PIL.Image.new('RGB', (1650, 1275), 'white')
+    return _measure(lambda: borders.add_borders_to_img(card, BORDER_IMG),
+                    args.repeat)
+
+
+def bench_add_borders(args) -> typing.Dict[str, typing.Any]:
+    """Rasterizing and bordering a whole document, per page"""
+    import task_cards.utils.borders as borders
+
+    if not os.path.exists(BORDER_IMG):
+        return _skipped(f'{BORDER_IMG} not found')
+    if shutil.which('pdflatex') is None:
+        return _skipped('pdflatex not found')
+    if shutil.which('pdftoppm') is None:
+        return _skipped('poppler not found')
+    pages = 4
+    pdf = _sample_pdf(pages)
+
+    return _measure(
+        lambda: borders.add_borders(pdf, 'out/bench_bordered.pdf', pages),
+        args.repeat, pages)
+
+
+STAGES = {
+    'generate': bench_generate,
+    'generate_batch': bench_generate_batch,
+    'create_graph': bench_create_graph,
+    'generate_doc_latex': bench_generate_doc_latex,
+    'pdflatex': bench_pdflatex,
+    'add_borders_to_img': bench_add_borders_to_img,
+    'add_borders': bench_add_borders,
+}
+
+
+def run_(args) -> typing.Dict[str, typing.Any]:
+    """Runs the selected stages in a temporary working directory. Whatever
+    the stages print, ex: the log of pdflatex, goes to stderr, so that
+    stdout only holds the results"""
+    stages = args.stages or list(STAGES)
+    results = dict()
+    old_cwd = os.getcwd()
+    sys.stdout.flush()
+    old_stdout = os.dup(1)
+    os.dup2(2, 1)  # also redirects subprocesses, unlike sys.stdout
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        try:
+            os.makedirs('out')
+            if os.path.exists(BORDER_IMG):  # add_borders uses img/ by default
+                os.makedirs('img')
+                shutil.copyfile(BORDER_IMG,
+                                os.path.join('img', 'border_1.jpg'))
+            for stage in stages:
+                results[stage] = STAGES[stage](args)
+        finally:
+            os.chdir(old_cwd)
+            sys.stdout.flush()
+            os.dup2(old_stdout, 1)
+            os.close(old_stdout)
+    return results
+
+
+def _flatten(results: typing.Dict[str, typing.Any], prefix: str = ''
+             ) -> typing.Dict[str, float]:
+    """Maps 'stage.sub' paths to seconds_per_op"""
+    res = dict()
+    for key, value in results.items():
+        if not isinstance(value, dict):
+            continue
+        if 'seconds_per_op' in value:
+            res[prefix + key] = value['seconds_per_op']
+        else:
+            res.update(_flatten(value, f'{prefix}{key}.'))
+    return res
+
+
+def compare(baseline: typing.Dict[str, typing.Any],
+            results: typing.Dict[str, typing.Any],
+            tolerance: float = 0.2) -> typing.List[str]:
+    """Returns a description of every benchmark which got slower than the
+    baseline by more than the tolerance (a fraction)"""
+    old = _flatten(baseline)
+    new = _flatten(results)
+    regressions = []
+    for key in sorted(old.keys() & new.keys()):
+        if new[key] > old[key] * (1 + tolerance):
+            regressions.append(
+                f'{key}: {old[key]:.6g}s -> {new[key]:.6g}s per op '
+                + f'({new[key] / old[key] - 1:+.0%})')
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
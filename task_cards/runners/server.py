@@ -0,0 +1,358 @@
+"""Serves decks over a local HTTP or unix socket from warm worker processes,
+so that a deck does not pay for starting python, importing numpy,
+matplotlib and PIL, discovering the tasks, loading upload.json and
+decoding the border image:
+
+    python -m task_cards.runners.server --port 8080 --workers 4
+    curl -d '{"tasks": ["PerfectSquaresTask"], "pages": 2, "seed": 1}' \\
+        http://127.0.0.1:8080/deck -o deck.pdf
+
+POST /deck takes a JSON object with the tasks, pages and seed of the deck,
+and optionally its borders, plots, qr and rasterizer (see
+task_cards.runners.uniform), and responds with the bordered pdf. GET
+/health responds once the workers are warm.
+
+Each deck is built by a single worker in a temporary directory which
+shares img/, cache/ and upload.json with the working directory of the
+server. At most --workers decks are built at once and at most
+--max-pending more wait for a worker; requests beyond that are refused
+with 503, and decks of more than --max-pages pages with 413. A deck which
+takes longer than --timeout is answered with 504, but keeps its place
+until its build is over, since a running build cannot be stopped. Should a
+worker die, the workers are restarted and the deck is tried once more.
+"""
+import argparse
+import task_cards.runners.uniform as uniform
+import task_cards.tasks.all as tasks_all
+import task_cards.utils.borders as borders
+import task_cards.utils.seeding as seeding
+import task_cards.utils.upload as upload
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import http.server
+import importlib
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
+import typing
+
+SHARED = ('img', 'cache', upload.CONFIG_FILE)
+"""What the temporary directory of each deck links to in the working
+directory of the server"""
+
+OPTIONS = ('borders', 'plots', 'qr', 'rasterizer')
+"""The options of uniform a request may set besides tasks, pages and seed"""
+
+MAX_REQUEST_BYTES = 64 * 1024
+"""The largest body of a request read, far more than any deck needs"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serves task card decks from warm worker processes')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='the address to listen on')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='the port to listen on')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='listen on this unix socket instead of a port')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='the number of decks built at once')
+    parser.add_argument('--max-pending', type=int, default=8,
+                        help='the number of requests which may wait for a '
+                        + 'worker before requests are refused')
+    parser.add_argument('--max-pages', type=int, default=25,
+                        help='the largest deck a request may ask for')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='the seconds a request waits for its deck')
+    parser.add_argument('--borders', type=str, default='vector',
+                        choices=['raster', 'vector'],
+                        help='the borders of decks which do not choose, '
+                        + 'vector by default since rasterizing is slow')
+    parser.add_argument('--plots', type=str, default='display',
+                        choices=['full', 'display', 'vector'],
+                        help='the plots of decks which do not choose')
+    parser.add_argument('--tex-format', action='store_true',
+                        help='compile with a cached precompiled preamble')
+    args = parser.parse_args()
+    run_(args)
+
+
+def run_(args):
+    os.makedirs('cache', exist_ok=True)  # so that every deck shares it
+    executor = start_pool(args.workers)
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixDeckServer(args.socket, DeckHandler)
+    else:
+        server = DeckServer((args.host, args.port), DeckHandler)
+    server.executor = executor
+    server.executor_lock = threading.Lock()
+    server.args = args
+    server.slots = threading.BoundedSemaphore(
+        args.workers + args.max_pending)
+
+    print(f'serving decks on {args.socket or (args.host, args.port)}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.executor.shutdown(wait=False, cancel_futures=True)
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+def start_pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    """Returns a pool of workers which are all warm
+
+    Arguments:
+        workers (int): the number of worker processes
+    """
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker)
+    # workers are forked on the first submit and warm up concurrently. A
+    # worker only runs work once its initializer is done, so all are warm
+    # once each has answered
+    pids = set()
+    while len(pids) < workers:
+        pids.update(executor.map(_worker_pid, range(workers)))
+    return executor
+
+
+def _init_worker():
+    """Does everything a deck needs that does not depend on the deck: the
+    tasks, and through them numpy, matplotlib and PIL, are imported, the
+    upload configuration is loaded and the border frame is decoded and
+    resized. These are all cached for the life of the worker"""
+    uniform._init_worker(None, 'full', 'tex')
+    for info in tasks_all.manifest():
+        info.load()
+    import task_cards.utils.mpl  # noqa: F401, not every task plots
+
+    for module in ('fitz', 'PyPDF2', 'qrcode'):
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass  # optional, the decks which need it will fail
+    try:
+        upload.config()
+    except FileNotFoundError:
+        pass  # only needed by tasks which upload
+    try:
+        # the size of a card, for vector borders and rasterized pages alike
+        borders.border_frame('img/border_1.jpg', (1650, 1275))
+    except FileNotFoundError:
+        pass  # decks will fail with a clearer error
+
+
+def _worker_pid(_) -> int:
+    """Returns the process id of the worker, after a moment so that the
+    other workers get to answer too"""
+    time.sleep(0.05)
+    return os.getpid()
+
+
+def _build_deck(argv: typing.List[str]) -> bytes:
+    """Builds the deck described by the arguments of uniform in a worker
+    and returns the bordered pdf. Workers build many decks, so whatever a
+    deck changes in the state of the process is undone afterwards"""
+    args = uniform.make_parser().parse_args(argv)
+    root = os.getcwd()
+    environ = dict(os.environ)  # build pins the dates of seeded decks
+    seeding.clear()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in SHARED:
+            if os.path.exists(name):
+                os.symlink(os.path.abspath(name), os.path.join(tmpdir, name))
+        os.chdir(tmpdir)
+        try:
+            os.makedirs('out')
+            uniform.build(args)
+            with open(os.path.join('out', 'bordered.pdf'), 'rb') as infile:
+                return infile.read()
+        finally:
+            os.chdir(root)
+            os.environ.clear()
+            os.environ.update(environ)
+            seeding.clear()
+
+
+def deck_argv(request: typing.Dict[str, typing.Any],
+              args) -> typing.List[str]:
+    """Returns the arguments of uniform for the deck requested, checking
+    them. Raises ValueError if the request is not a valid deck
+
+    Arguments:
+        request (dict): the JSON object of the request
+        args: the arguments of the server, whose options apply to decks
+            which do not set them
+    """
+    if not isinstance(request, dict):
+        raise ValueError('expected a JSON object')
+    unknown = request.keys() - {'tasks', 'pages', 'seed'} - set(OPTIONS)
+    if unknown:
+        raise ValueError(f'unknown keys: {", ".join(sorted(unknown))}')
+    tasks_ = request.get('tasks')
+    if (not isinstance(tasks_, list) or not tasks_
+            or not all(isinstance(task_id, str) for task_id in tasks_)):
+        raise ValueError('tasks must be a non-empty list of task ids')
+    pages = request.get('pages', 1)
+    # bools are ints to python, but true pages or a seed of false are not
+    if not isinstance(pages, int) or isinstance(pages, bool) or pages < 1:
+        raise ValueError('pages must be a positive integer')
+    seed = request.get('seed')
+    if seed is not None and (not isinstance(seed, int)
+                             or isinstance(seed, bool)):
+        raise ValueError('seed must be an integer')
+
+    options = dict(borders=args.borders, plots=args.plots)
+    options.update({key: request[key] for key in OPTIONS if key in request})
+    argv = ['--pages', str(pages), '--tasks', *tasks_, '--jobs', '1']
+    if seed is not None:
+        argv += ['--seed', str(seed)]
+    for key, value in options.items():
+        argv += [f'--{key}', str(value)]
+    if args.tex_format:
+        argv.append('--tex-format')
+
+    try:
+        uniform.make_parser().parse_args(argv)
+    except SystemExit:  # argparse has printed why
+        raise ValueError('invalid options, see the server log')
+    for task_id in tasks_:
+        try:
+            tasks_all.find_task_info(task_id)
+        except KeyError:
+            raise ValueError(f'unknown task: {task_id}')
+    return argv
+
+
+class DeckHandler(http.server.BaseHTTPRequestHandler):
+    """Answers deck requests, see the module docstring"""
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_error(404, 'not found')
+            return
+        self._send(200, 'application/json', b'{"status": "ok"}')
+
+    def do_POST(self):
+        if self.path != '/deck':
+            self._send_error(404, 'not found')
+            return
+        args = self.server.args
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self._send_error(400, 'invalid Content-Length')
+            return
+        if length < 0:
+            self._send_error(400, 'invalid Content-Length')
+            return
+        if length > MAX_REQUEST_BYTES:  # checked before reading any of it
+            self._send_error(413, f'at most {MAX_REQUEST_BYTES} bytes')
+            return
+        try:
+            argv = deck_argv(json.loads(self.rfile.read(length)), args)
+        except ValueError as exc:  # includes invalid JSON
+            self._send_error(400, str(exc))
+            return
+        if int(argv[argv.index('--pages') + 1]) > args.max_pages:
+            self._send_error(413, f'at most {args.max_pages} pages')
+            return
+
+        # a worker which dies, say of the OOM killer, breaks the whole pool,
+        # so it is replaced and the deck is tried once more
+        for attempt in range(2):
+            slots = self.server.slots
+            if not slots.acquire(blocking=False):
+                self._send_error(503, 'too many pending decks')
+                return
+            executor = self.server.executor
+            try:
+                pdf = self._build(executor, argv, slots)
+            except BrokenProcessPool:
+                self.log_error('the pool of workers broke')
+                if attempt == 0 and self._replace_pool(executor):
+                    continue
+                self._send_error(503, 'the workers are restarting')
+                return
+            except concurrent.futures.TimeoutError:
+                self._send_error(504, 'the deck took too long')
+                return
+            except Exception as exc:
+                self.log_error('deck failed: %r', exc)
+                self._send_error(500, f'the deck failed: {exc}')
+                return
+            self._send(200, 'application/pdf', pdf)
+            return
+
+    def _build(self, executor, argv: typing.List[str], slots) -> bytes:
+        """Builds the deck in the pool. The slot acquired for it is held
+        until the build is over rather than until this request gives up on
+        it, so stuck builds count against the limit"""
+        try:
+            future = executor.submit(_build_deck, argv)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result(timeout=self.server.args.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()  # only stops decks still waiting for a worker
+            raise
+
+    def _replace_pool(self, broken) -> bool:
+        """Replaces the broken pool of the server by a warm one unless
+        another request already has. Returns whether there is a working
+        pool"""
+        with self.server.executor_lock:
+            if self.server.executor is not broken:
+                return True
+            broken.shutdown(wait=False, cancel_futures=True)
+            try:
+                self.server.executor = start_pool(self.server.args.workers)
+            except Exception as exc:
+                self.log_error('could not restart the workers: %r', exc)
+                return False
+            return True
+
+    def _send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str):
+        self._send(status, 'application/json',
+                   json.dumps(dict(error=message)).encode('utf-8'))
+
+    def address_string(self) -> str:
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return 'unix'  # clients of unix sockets have no address
+
+
+class DeckServer(http.server.ThreadingHTTPServer):
+    """Serves decks over TCP. The runner sets executor, executor_lock, args
+    and slots"""
+    daemon_threads = True
+
+
+class UnixDeckServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    """Serves decks over a unix socket, see DeckServer"""
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,35 @@ import argparse
 import task_cards.utils.tex as tex
 import task_cards.tasks.all as tasks_all
 import task_cards.utils.borders as borders
+import task_cards.utils.pool as pool
+import task_cards.utils.seeding as seeding
+import task_cards.utils.tracing as tracing
+import task_cards.utils.card_cache as card_cache
+import task_cards.utils.card as card
+import concurrent.futures
+import contextlib
+import functools
 import random
 import io
 import shutil
+import sys
 import os
 import time
+import typing
+
+BATCH_PAGES = 16
+"""The number of pages whose cards are generated and whose assets are
+rendered together, see _generate_card_lists"""
 
 
 def main():
+    args = make_parser().parse_args()
+    run_(args)
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """Returns the parser of the command line arguments, which other
+    runners reuse to describe a deck"""
     parser = argparse.ArgumentParser(
         description='Generates task cards from the list')
     parser.add_argument('--pages', type=int, default=1,
@@ -20,44 +41,477 @@ def main():
     parser.add_argument('--tasks', type=str, nargs='+',
                         default=['PerfectSquaresTask'],
                         help='The tasks that you want to include')
-    args = parser.parse_args()
-    run_(args)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='the number of processes used to generate pages')
+    parser.add_argument('--rasterizer', type=str, default='pdf2image',
+                        choices=sorted(borders.RASTERIZERS),
+                        help='how the pdf is converted to images for borders')
+    parser.add_argument('--tex-chunk-size', type=int, default=0,
+                        help='if positive, compile the pages in documents of '
+                        + 'this many pages which are merged afterwards')
+    parser.add_argument('--tex-jobs', type=int, default=None,
+                        help='the number of concurrent pdflatex processes '
+                        + 'for chunked documents, defaults to --jobs')
+    parser.add_argument('--tex-format', action='store_true',
+                        help='compile with a cached precompiled preamble')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='makes the deck reproducible: every card is '
+                        + 'generated from this seed, its page and its slot')
+    parser.add_argument('--shard', type=_shard, default=(0, 1),
+                        help='i/N generates only the i-th (0-indexed) of N '
+                        + 'contiguous runs of pages, ex: 0/4')
+    parser.add_argument('--borders', type=str, default='raster',
+                        choices=['raster', 'vector'],
+                        help='raster borders the pages after rendering them '
+                        + 'to images, vector draws them in the latex document')
+    parser.add_argument('--profile', action='store_true',
+                        help='record the time and memory of each stage and '
+                        + 'task to out/trace.json and out/profile.txt')
+    parser.add_argument('--plots', type=str, default='full',
+                        choices=['full', 'display', 'vector'],
+                        help='full renders graphs as 4500px images, display '
+                        + 'at the size they are printed and vector as pdfs')
+    parser.add_argument('--qr', type=str, default='tex',
+                        choices=list(tex.QR_MODES),
+                        help='tex has pdflatex compute the answer QR codes, '
+                        + 'vector computes them in python (needs qrcode)')
+    parser.add_argument('--pipeline-chunk', type=int, default=0,
+                        help='if positive, generate, compile and border '
+                        + 'chunks of this many pages concurrently instead of '
+                        + 'one stage after the other')
+    parser.add_argument('--card-cache', type=str, default=None,
+                        help='a directory of bordered cards kept between '
+                        + 'runs, so only new cards are compiled and '
+                        + 'bordered, ex: cache/cards')
+    parser.add_argument('--card-cache-size', type=int, default=1024,
+                        help='the size in MB the card cache is evicted to')
+    return parser
 
 
-def run_(args):
-    if os.path.exists('out'):
-        shutil.rmtree('out')
-        time.sleep(1)
-    os.makedirs('out')
+def _shard(value: str) -> typing.Tuple[int, int]:
+    """Parses i/N into (i, N)"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected i/N, got {value}')
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'expected 0 <= i < N, got {value}')
+    return index, count
+
+
+def _shard_pages(args) -> range:
+    """Returns the indices of the pages in this run's shard of the deck"""
+    index, count = args.shard
+    return range(args.pages * index // count,
+                 args.pages * (index + 1) // count)
+
+
+def _set_plots(plots: str):
+    """Chooses how graphs are output. matplotlib is slow to import, so it is
+    left alone unless the default is changed or it was imported already,
+    ex: by an earlier deck built in the same process"""
+    if plots != 'full' or 'task_cards.utils.mpl' in sys.modules:
+        import task_cards.utils.mpl as umpl
+        umpl.set_output_mode(plots)
+
+
+def _init_worker(trace_dir: typing.Optional[str], plots: str, qr: str):
+    """Reseeds the random generators in a pool worker, chooses how graphs
+    and QR codes are output and turns on tracing if the run is profiled.
+    Forked workers inherit the parent's random state, which would otherwise
+    make every worker produce the same sequence of cards. numpy seeds itself
+    when it is first imported, so it only needs reseeding if it was
+    inherited"""
+    if trace_dir is not None:
+        tracing.enable(trace_dir)
+    _set_plots(plots)
+    tex.set_qr_mode(qr)
+    random.seed()
+    if 'numpy' in sys.modules:
+        sys.modules['numpy'].random.seed()
+
+
+def _generate_cards(tasks_: typing.List[type], seed: typing.Optional[int],
+                    page: int) -> typing.List[card.Card]:
+    """Generates the cards of a single page by choosing 4 tasks uniformly at
+    random
 
-    tasks_ = []
-    for task_id in args.tasks:
-        if task_id in tasks_all.TASKS_BY_MODULE_AND_NAME:
-            tasks_.append(tasks_all.TASKS_BY_MODULE_AND_NAME[task_id])
-        else:
-            tasks_.append(tasks_all.TASKS_BY_NAME[task_id])
+    Arguments:
+        tasks_ (list[type]): the task classes to choose from
+        seed (int, optional): the seed of the deck. If given, each card is
+            generated from its own seed, so the page does not depend on
+            what was generated before it
+        page (int): the index of the page in the deck
+    Returns:
+        The cards, whose assets are not rendered yet
+    """
+    cards = []
+    if seed is None:
+        seeding.clear()  # a seeded deck may have come before
+    for slot in range(4):
+        if seed is not None:
+            seeding.seed_card(seed, page, slot)
+        task_cls = random.choice(tasks_)
+        with tracing.span(task_cls.__name__, 'task'):
+            cards.append(task_cls().generate_card())
+    return cards
 
-    pages = []
-    imports = {'qrcode', 'graphicx'}
+
+def _generate_resolved_cards(tasks_: typing.List[type],
+                             seed: typing.Optional[int],
+                             page: int) -> typing.List[card.Card]:
+    """Generates cards like _generate_cards, but waits for the uploads
+    their tasks started. Used in pool workers, since upload placeholders can
+    only be resolved in the process that created them"""
+    cards = _generate_cards(tasks_, seed, page)
+    with tracing.span('wait for uploads', 'upload'):
+        for crd in cards:
+            crd.resolve_uploads()
+    tracing.flush()  # workers are not told when the pool shuts down
+    return cards
+
+
+def _required_imports_and_preambles(
+        tasks_: typing.List[type], bordered: bool) -> typing.Tuple[
+            typing.Set[str], typing.Dict[str, str]]:
+    """Returns the imports and preambles of the document, which are known
+    from the task classes before any card is generated"""
+    qr_imports, qr_preambles = tex.qr_requirements()
+    imports = {'graphicx'}.union(qr_imports)
     preambles = {
         'margin': '\\usepackage[margin=0in]{geometry}',
         'parindent': '\\setlength\\parindent{0pt}'
     }
-    for _ in range(args.pages):
-        page_task_codes = []
-        for _ in range(4):
-            tsk = random.choice(tasks_)()
-            page_task_codes.append(tsk.generate())
-            imports = imports.union(tsk.imports)
-            preambles.update(tsk.preambles)
+    preambles.update(qr_preambles)
+    if bordered:
+        imports = imports.union({'eso-pic'})
+        preambles.update(tex.border_preamble('border_frame.jpg'))
+    for task_cls in tasks_:
+        tsk = task_cls()
+        imports = imports.union(tsk.imports)
+        preambles.update(tsk.preambles)
+    return imports, preambles
+
+
+def _generation_pool(args) -> typing.Optional[
+        concurrent.futures.ProcessPoolExecutor]:
+    """Returns the pool of processes that generate cards, or None if they
+    are generated in this process"""
+    if args.jobs <= 1:
+        return None
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.jobs, initializer=_init_worker,
+        initargs=(_trace_dir(args), args.plots, args.qr))
+
+
+def _card_lists(tasks_: typing.List[type], args, imports: typing.Set[str],
+                preambles: typing.Dict[str, str], pages: range,
+                executor: typing.Optional[concurrent.futures.Executor]
+                ) -> typing.List[typing.List[str]]:
+    """Returns the latex of the 4 cards of each of the pages in order. The
+    cards are generated first, then the assets of all of them are rendered
+    in one batch, each distinct asset once, and only then are the cards
+    written as latex.
+
+    Arguments:
+        executor (Executor, optional): the pool from _generation_pool
+    """
+    if executor is not None:
+        # results come back in submission order, so the page order does not
+        # depend on which worker finishes first
+        results = pool.ordered_map(
+            executor,
+            functools.partial(_generate_resolved_cards, tasks_, args.seed),
+            pages, args.jobs * 4)
+        card_pages = list(_checked_cards(results, imports, preambles))
+    else:
+        results = (_generate_cards(tasks_, args.seed, page) for page in pages)
+        card_pages = list(_checked_cards(results, imports, preambles))
+        with tracing.span('wait for uploads', 'upload'):
+            for cards in card_pages:
+                for crd in cards:
+                    crd.resolve_uploads()
+
+    with tracing.span('render assets'):
+        rendered = card.render_assets(
+            (crd for cards in card_pages for crd in cards), args.jobs,
+            executor)
+    return [[crd.latex(rendered) for crd in cards] for cards in card_pages]
+
+
+def _generate_card_lists(tasks_: typing.List[type], args,
+                         imports: typing.Set[str],
+                         preambles: typing.Dict[str, str]
+                         ) -> typing.Iterator[typing.List[str]]:
+    """Yields the latex of the 4 cards of each page of the deck in order,
+    see _card_lists. The pages are generated in blocks, rendering the
+    assets of one block at a time, so that memory stays bounded and the
+    first pages can be written before the rest of the deck is generated.
+    Assets shared between blocks are rendered once per block, but graphs
+    are also cached on disk by mpl.cached_graph."""
+    pages = _shard_pages(args)
+    block = max(BATCH_PAGES, args.jobs * 4)  # keep every worker busy
+    with _generation_pool(args) or contextlib.nullcontext() as executor:
+        for start in range(0, len(pages), block):
+            yield from _card_lists(tasks_, args, imports, preambles,
+                                   pages[start:start + block], executor)
+
+
+def _generate_pages(tasks_: typing.List[type], args, bordered: bool,
+                    imports: typing.Set[str],
+                    preambles: typing.Dict[str, str]) -> typing.Iterator[str]:
+    """Yields the latex for each page in order as it is generated. See
+    _generate_card_lists"""
+    for cards in _generate_card_lists(tasks_, args, imports, preambles):
         writer = io.StringIO()
-        tex.generate_task_page(writer, page_task_codes)
-        pages.append(writer.getvalue())
+        tex.generate_task_page(writer, cards, bordered=bordered)
+        yield writer.getvalue()
+
+
+def _checked_cards(results: typing.Iterable[typing.List[card.Card]],
+                   imports: typing.Set[str],
+                   preambles: typing.Dict[str, str]
+                   ) -> typing.Iterator[typing.List[card.Card]]:
+    """Yields the cards from the results of _generate_cards, making sure
+    each card only needs the imports and preambles that were written
+    before the first page"""
+    for cards in results:
+        for crd in cards:
+            if (not crd.imports <= imports
+                    or not crd.preambles.keys() <= preambles.keys()):
+                raise ValueError('a card needs imports or preambles its '
+                                 + 'task did not declare up front')
+        yield cards
+
+
+def _trace_dir(args) -> typing.Optional[str]:
+    """Where the processes of a profiled run write their spans"""
+    return os.path.join('out', 'trace') if args.profile else None
+
+
+def run_(args):
+    if os.path.exists('out'):
+        shutil.rmtree('out')
+        time.sleep(1)
+    os.makedirs('out')
+
+    if not args.profile:
+        build(args)
+        return
+
+    tracing.enable(_trace_dir(args))
+    try:
+        with tracing.span('total'):
+            build(args)
+    finally:
+        tracing.flush()
+        events = tracing.collect(_trace_dir(args))
+        tracing.write_chrome_trace(events, os.path.join('out', 'trace.json'))
+        table = tracing.summary(events)
+        with open(os.path.join('out', 'profile.txt'), 'w') as outfile:
+            outfile.write(table + '\n')
+        print(table, file=sys.stderr)
+
+
+def build(args):
+    """Generates, compiles and borders the deck in out/, which must exist.
+    See make_parser for the arguments"""
+    with tracing.span('find tasks'):
+        tasks_ = [tasks_all.find_task(task_id) for task_id in args.tasks]
+    if args.seed is not None:
+        # pin the timestamps pdflatex and the pdf writers embed, so the
+        # same seed gives the same bytes
+        os.environ.setdefault('SOURCE_DATE_EPOCH', '0')
+        os.environ.setdefault('FORCE_SOURCE_DATE', '1')
+
+    _set_plots(args.plots)
+    tex.set_qr_mode(args.qr)
+    bordered = args.borders == 'vector'
+    if args.card_cache is not None and bordered:
+        raise ValueError('the card cache needs raster borders')
+    if args.card_cache is not None and args.pipeline_chunk > 0:
+        raise ValueError('the card cache cannot be pipelined')
+    if bordered:
+        borders.save_border_frame('out/border_frame.jpg')
+    imports, preambles = _required_imports_and_preambles(tasks_, bordered)
+
+    fmt = None
+    if args.tex_format:
+        with tracing.span('preamble format'):
+            fmt = tex.preamble_format(imports, preambles)
+
+    if args.card_cache is not None:
+        _build_from_card_cache(tasks_, args, imports, preambles, fmt)
+        return
+    if args.pipeline_chunk > 0:
+        _build_pipelined(tasks_, args, bordered, imports, preambles, fmt)
+        return
+
+    pages = _generate_pages(tasks_, args, bordered, imports, preambles)
+    _compile(args, imports, preambles, pages, fmt)
+    if bordered:
+        shutil.copyfile('out/out.pdf', 'out/bordered.pdf')
+        return
+
+    with tracing.span('add borders'):
+        borders.add_borders('out/out.pdf', 'out/bordered.pdf',
+                            len(_shard_pages(args)),
+                            args.jobs, _rasterizer(args))
+
+
+def _compile(args, imports: typing.Set[str],
+             preambles: typing.Dict[str, str], pages: typing.Iterable[str],
+             fmt: typing.Optional[str]):
+    """Writes and compiles the pages to out/out.pdf"""
+    if args.tex_chunk_size > 0:
+        tex.pdflatex_chunked(
+            'out/out.pdf', imports, preambles, pages, 'out',
+            args.tex_chunk_size, args.tex_jobs or args.jobs, fmt)
+    else:
+        # the pages are generated while they are written
+        with tracing.span('generate and write tex'):
+            with open('out/out.tex', 'w') as outfile:
+                tex.generate_doc_latex(outfile, imports, preambles, pages)
+        tex.pdflatex('out/out.tex', 'out', fmt)
+
+
+def _rasterizer(args) -> typing.Optional[borders.Rasterizer]:
+    """Returns the rasterizer chosen on the command line, or None for the
+    default pdftoppm rasterizer (pdf2image), which shares the number of jobs"""
+    if args.rasterizer == 'pdf2image':
+        return None
+    return borders.RASTERIZERS[args.rasterizer]()
+
+
+def _card_cache_salt(args) -> str:
+    """Describes what the rendering of a card depends on besides its
+    latex and the preambles"""
+    border_img = 'img/border_1.jpg'  # the default of add_borders_to_img
+    stat = os.stat(border_img)
+    return (f'{args.rasterizer}:{border_img}:{stat.st_mtime_ns}:'
+            + f'{stat.st_size}')
+
+
+def _build_from_card_cache(tasks_: typing.List[type], args,
+                           imports: typing.Set[str],
+                           preambles: typing.Dict[str, str],
+                           fmt: typing.Optional[str]):
+    """Builds out/bordered.pdf from the card cache, compiling and bordering
+    only the cards which are not already cached. out/out.pdf then only
+    holds the cards which had to be compiled."""
+    cache = card_cache.CardCache(args.card_cache,
+                                 args.card_cache_size * 1024 * 1024)
+    salt = _card_cache_salt(args)
+
+    # cards are cropped at different offsets in each quarter of a page, so
+    # a card is cached, and compiled, per slot
+    page_keys = []
+    missing = [dict() for _ in range(4)]  # uncached latex by key, per slot
+    with tracing.span('generate and hash cards'):
+        for cards in _generate_card_lists(tasks_, args, imports, preambles):
+            keys = [card_cache.card_key(crd, imports, preambles,
+                                        f'{salt}:{slot}')
+                    for slot, crd in enumerate(cards)]
+            for slot, (key, crd) in enumerate(zip(keys, cards)):
+                if key not in missing[slot] and not cache.has(key):
+                    missing[slot][key] = crd
+            page_keys.append(keys)
+
+    if any(missing):
+        by_slot = [list(slot_cards.items()) for slot_cards in missing]
+        pages = []
+        compiled_keys = []  # in the order bordered_cards yields the cards
+        for page in range(max(len(items) for items in by_slot)):
+            # slots which run out of missing cards are left blank
+            entries = [items[page] if page < len(items) else (None, '')
+                       for items in by_slot]
+            writer = io.StringIO()
+            tex.generate_task_page(writer, [crd for _, crd in entries])
+            pages.append(writer.getvalue())
+            compiled_keys.extend(key for key, _ in entries)
+        _compile(args, imports, preambles, pages, fmt)
+
+        with tracing.span('border cards'):
+            rendered = borders.bordered_cards(
+                'out/out.pdf', len(pages), args.jobs, _rasterizer(args))
+            for key, img in zip(compiled_keys, rendered):
+                if key is not None:
+                    cache.put(key, img)
+
+    with tracing.span('assemble pages'):
+        borders.write_card_pages(
+            'out/bordered.pdf',
+            ([cache.get(key) for key in keys] for keys in page_keys))
+    cache.evict()
+
+
+def _build_pipelined(tasks_: typing.List[type], args, bordered: bool,
+                     imports: typing.Set[str],
+                     preambles: typing.Dict[str, str],
+                     fmt: typing.Optional[str]):
+    """Builds out/bordered.pdf from chunks of --pipeline-chunk pages which
+    flow through three overlapping stages: generating, compiling and
+    bordering. While one chunk is bordered, the following ones are compiled
+    and generated. Each stage only runs a couple of chunks ahead of the
+    next, so memory stays bounded, and the wall time approaches that of the
+    slowest stage instead of the sum of all of them."""
+    pages = _shard_pages(args)
+    chunks = [pages[start:start + args.pipeline_chunk]
+              for start in range(0, len(pages), args.pipeline_chunk)]
+    tex_jobs = args.tex_jobs or args.jobs
+    rasterizer = _rasterizer(args)
+
+    def generate(chunk: range) -> typing.List[str]:
+        with tracing.span('generate chunk'):
+            card_lists = _card_lists(tasks_, args, imports, preambles, chunk,
+                                     gen_executor)
+        chunk_pages = []
+        for cards in card_lists:
+            writer = io.StringIO()
+            tex.generate_task_page(writer, cards, bordered=bordered)
+            chunk_pages.append(writer.getvalue())
+        return chunk_pages
+
+    def compile_(item: typing.Tuple[int, typing.List[str]]
+                 ) -> typing.Tuple[str, int]:
+        index, chunk_pages = item
+        latexfile = os.path.join('out', f'pipeline_{index}.tex')
+        with tracing.span('write tex'):
+            with open(latexfile, 'w') as outfile:
+                tex.generate_doc_latex(outfile, imports, preambles,
+                                       chunk_pages)
+        tex.pdflatex(latexfile, 'out', fmt)
+        return os.path.splitext(latexfile)[0] + '.pdf', len(chunk_pages)
+
+    with contextlib.ExitStack() as stack:
+        gen_executor = _generation_pool(args)
+        border_executor = None
+        if gen_executor is not None:
+            stack.enter_context(gen_executor)
+            border_executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs))
+            # start the workers before the stage threads, since forking a
+            # process which is running other threads can deadlock
+            gen_executor.submit(int).result()
+            border_executor.submit(int).result()
+
+        generator = stack.enter_context(
+            concurrent.futures.ThreadPoolExecutor(max_workers=1))
+        compiler = stack.enter_context(
+            concurrent.futures.ThreadPoolExecutor(max_workers=tex_jobs))
+        generated = pool.ordered_map(generator, generate, chunks, 2)
+        compiled = pool.ordered_map(compiler, compile_, enumerate(generated),
+                                    tex_jobs + 1)
+
+        if bordered:  # the pages already have their borders
+            tex.merge_pdfs([pdf for pdf, _ in compiled], 'out/bordered.pdf')
+            return
 
-    with open('out/out.tex', 'w') as outfile:
-        tex.generate_doc_latex(outfile, imports, preambles, pages)
-    tex.pdflatex('out/out.tex', 'out')
-    borders.add_borders('out/out.pdf', 'out/bordered.pdf', args.pages)
+        bordered_pages = (
+            page for pdf, num in compiled
+            for page in borders.bordered_pages(pdf, num, args.jobs,
+                                               rasterizer, border_executor))
+        borders.write_pdf('out/bordered.pdf', bordered_pages)
 
 
 if __name__ == '__main__':
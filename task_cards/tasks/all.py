@@ -1,16 +1,58 @@
 """Returns a list of all the tasks. Assumes all python files in
-task or subfolders of task include a Task file. Not the worlds
-fastest solution, but seamless"""
+task or subfolders of task include a Task file.
+
+Discovering the tasks requires importing every task module, which pulls in
+numpy, matplotlib and friends. The result of discovery is therefore kept in
+a manifest (module, class name, categories, imports and preambles of each
+task) cached next to the compiled modules, and it is only rebuilt when a
+task file, or a module that decides the imports and preambles of tasks,
+changes. Looking tasks up and filtering them by category uses
+the manifest alone; only the tasks a run actually uses are imported.
+
+ALL_TASKS, TASKS_BY_MODULE_AND_NAME and TASKS_BY_NAME are still available,
+but accessing them imports every task.
+"""
 
 import task_cards.tasks.task as task
 import os
 import typing
 import importlib
+import json
+
+TASKS_DIR = os.path.dirname(os.path.abspath(__file__))
+TASKS_PREFIX = 'task_cards.tasks.'
+MANIFEST_FILE = os.path.join(TASKS_DIR, '__pycache__', 'tasks_manifest.json')
+MANIFEST_VERSION = 1
+MANIFEST_DEPENDENCIES = (
+    os.path.join(TASKS_DIR, 'task.py'),
+    *(os.path.join(os.path.dirname(TASKS_DIR), 'utils', f'{name}.py')
+      for name in ('graphs', 'pgf', 'qr', 'tex'))
+)
+"""The modules besides the task files whose changes invalidate the
+manifest, since they decide the imports and preambles of tasks"""
+
+
+class TaskInfo(typing.NamedTuple):
+    """Describes a task without importing it"""
+    module: str
+    name: str
+    categories: typing.FrozenSet[task.TaskCategory]
+    imports: typing.FrozenSet[str]
+    preambles: typing.Dict[str, str]
+
+    @property
+    def task_id(self) -> str:
+        """The fully qualified identifier, ex: 'module.Name'"""
+        return f'{self.module}.{self.name}'
+
+    def load(self) -> typing.Type[task.Task]:
+        """Imports the module of the task and returns the task class"""
+        return getattr(importlib.import_module(self.module), self.name)
 
 
-def _find_tasks(prefix: str, folder: str) -> typing.Set[task.Task]:
-    """Recursively search the tasks folder for tasks"""
-    res = set()
+def _task_files(prefix: str, folder: str
+                ) -> typing.Iterator[typing.Tuple[str, str]]:
+    """Recursively yields the module name and path of every task file"""
     with os.scandir(folder) as it:
         for entry in it:
             entry: os.DirEntry
@@ -19,30 +61,145 @@ def _find_tasks(prefix: str, folder: str) -> typing.Set[task.Task]:
                     continue
 
                 fname_wo_ext = os.path.splitext(entry.name)[0]
-                try:
-                    module = importlib.import_module(prefix + fname_wo_ext)
-
-                    for nm, attr in module.__dict__.items():
-                        if (isinstance(attr, type)
-                                and issubclass(attr, task.Task)):
-                            res.add(attr)
-                except Exception as exc:
-                    raise ImportError(
-                        f'{prefix} in {folder} -> {entry.name}') from exc
-            elif entry.is_dir():
-                res = res.union(_find_tasks(f'{prefix}.{entry.name}',
-                                            entry.path))
+                yield prefix + fname_wo_ext, entry.path
+            elif entry.is_dir() and entry.name != '__pycache__':
+                yield from _task_files(f'{prefix}{entry.name}.', entry.path)
 
+
+def _fingerprint() -> typing.Dict[str, typing.List[int]]:
+    """The modification time and size of every task file and of
+    MANIFEST_DEPENDENCIES, which decide if the cached manifest is still
+    valid"""
+    paths = dict(_task_files(TASKS_PREFIX, TASKS_DIR))
+    paths.update((os.path.basename(path), path)
+                 for path in MANIFEST_DEPENDENCIES)
+    res = dict()
+    for name, path in paths.items():
+        stat = os.stat(path)
+        res[name] = [stat.st_mtime_ns, stat.st_size]
+    return res
+
+
+def _find_tasks() -> typing.List[TaskInfo]:
+    """Imports every task module and describes the tasks within"""
+    res = []
+    for module_name, path in _task_files(TASKS_PREFIX, TASKS_DIR):
+        try:
+            module = importlib.import_module(module_name)
+        except Exception as exc:
+            raise ImportError(f'{module_name} in {path}') from exc
+
+        for nm, attr in module.__dict__.items():
+            if (isinstance(attr, type)
+                    and issubclass(attr, task.Task)
+                    and attr.__module__ == module_name):
+                inst = attr()
+                res.append(TaskInfo(
+                    module_name, nm, frozenset(inst.task_categories),
+                    frozenset(inst.imports), dict(inst.preambles)))
     return res
 
 
-ALL_TASKS = _find_tasks('task_cards.tasks.', os.path.join('task_cards', 'tasks'))
+def _load_manifest(fingerprint: typing.Dict[str, typing.List[int]]
+                   ) -> typing.Optional[typing.List[TaskInfo]]:
+    """Returns the cached manifest or None if it is missing or stale"""
+    try:
+        with open(MANIFEST_FILE, 'r') as infile:
+            cached = json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+    if (cached.get('version') != MANIFEST_VERSION
+            or cached.get('fingerprint') != fingerprint):
+        return None
+
+    return [
+        TaskInfo(
+            info['module'], info['name'],
+            frozenset(task.TaskCategory(cat) for cat in info['categories']),
+            frozenset(info['imports']), info['preambles'])
+        for info in cached['tasks']
+    ]
+
+
+def _save_manifest(fingerprint: typing.Dict[str, typing.List[int]],
+                   infos: typing.List[TaskInfo]):
+    """Caches the manifest. Failing to write it is not an error"""
+    cached = {
+        'version': MANIFEST_VERSION,
+        'fingerprint': fingerprint,
+        'tasks': [
+            {
+                'module': info.module,
+                'name': info.name,
+                'categories': sorted(int(cat) for cat in info.categories),
+                'imports': sorted(info.imports),
+                'preambles': info.preambles
+            }
+            for info in infos
+        ]
+    }
+    try:
+        os.makedirs(os.path.dirname(MANIFEST_FILE), exist_ok=True)
+        tmp_file = f'{MANIFEST_FILE}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as outfile:
+            json.dump(cached, outfile)
+        os.replace(tmp_file, MANIFEST_FILE)
+    except OSError:
+        pass
+
+
+_MANIFEST = None
+
+
+def manifest() -> typing.List[TaskInfo]:
+    """Returns the description of every task, from the cache if possible"""
+    global _MANIFEST
+    if _MANIFEST is None:
+        fingerprint = _fingerprint()
+        infos = _load_manifest(fingerprint)
+        if infos is None:
+            infos = _find_tasks()
+            _save_manifest(fingerprint, infos)
+        _MANIFEST = infos
+    return _MANIFEST
+
+
+def find_task_info(task_id: str) -> TaskInfo:
+    """Returns the description of the task with the given fully qualified
+    identifier ('module.Name') or name. Duplicate names are chosen
+    arbitrarily."""
+    by_name = None
+    for info in manifest():
+        if info.task_id == task_id:
+            return info
+        if info.name == task_id:
+            by_name = info
+    if by_name is None:
+        raise KeyError(task_id)
+    return by_name
+
+
+def find_task(task_id: str) -> typing.Type[task.Task]:
+    """Imports and returns the task with the given fully qualified
+    identifier ('module.Name') or name"""
+    return find_task_info(task_id).load()
+
+
+def tasks_in_categories(categories: typing.Iterable[task.TaskCategory]
+                        ) -> typing.List[TaskInfo]:
+    """Returns the tasks which belong to any of the given categories,
+    without importing them"""
+    categories = set(categories)
+    return [info for info in manifest() if info.categories & categories]
 
-TASKS_BY_MODULE_AND_NAME = dict()
-TASKS_BY_NAME = dict()  # duplicates chosen arbitrarily
 
-for task_ in ALL_TASKS:
-    module = task_.__module__
-    name = task_.__name__
-    TASKS_BY_MODULE_AND_NAME[f'{module}.{name}'] = task_
-    TASKS_BY_NAME[name] = task_
+def __getattr__(name: str):
+    """Builds the eager task collections on first access"""
+    if name == 'ALL_TASKS':
+        return {info.load() for info in manifest()}
+    if name == 'TASKS_BY_MODULE_AND_NAME':
+        return {info.task_id: info.load() for info in manifest()}
+    if name == 'TASKS_BY_NAME':  # duplicates chosen arbitrarily
+        return {info.name: info.load() for info in manifest()}
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
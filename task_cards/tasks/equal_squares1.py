@@ -3,18 +3,30 @@
 """
 import task_cards.utils.tex as tex
 import task_cards.tasks.task as task
-import random
+import task_cards.utils.params as params
 import io
 
 MIN_SQRT = 2
 MAX_SQRT = 12
 
+PROBLEMS = params.ParamSpace('equal_squares1', [
+    (sqrt, plus_what)
+    for sqrt in range(MIN_SQRT, MAX_SQRT + 1)
+    for plus_what in range(-10, 11)
+])
+
 
 class SolveQuadByEqualSquares1Task(task.Task):
     def generate(self, style=tex.TaskStyle.Minimal):
-        sqrt = random.randint(MIN_SQRT, MAX_SQRT)
+        sqrt, plus_what = PROBLEMS.draw()
+        return self._card(sqrt, plus_what, style)
+
+    def generate_batch(self, n, rng, style=tex.TaskStyle.Minimal):
+        return [self._card(sqrt, plus_what, style)
+                for sqrt, plus_what in PROBLEMS.draw_batch(n, rng)]
+
+    def _card(self, sqrt, plus_what, style):
         square = sqrt * sqrt
-        plus_what = random.randint(-10, 10)
         if plus_what < 0:
             sign = '-'
             number = abs(plus_what)
@@ -3,14 +3,17 @@ import task_cards.tasks.task as task
 import task_cards.utils.tex as tex
 import random
 import numpy as np
-import task_cards.utils.mpl as umpl
-import uuid
-import os
-import io
+import task_cards.utils.graphs as graphs
+import task_cards.utils.card as card
 
 
 class ExpoQualitativeTask(task.Task):
+    graph_backend = 'mpl'  # see task_cards.utils.graphs
+
     def generate(self, style=tex.TaskStyle.Minimal):
+        return self.generate_card(style).render()
+
+    def generate_card(self, style=tex.TaskStyle.Minimal):
         a_pos = random.random() < 0.5
         b_bigger_one = random.random() < 0.5
 
@@ -30,9 +33,7 @@ class ExpoQualitativeTask(task.Task):
         xs = np.linspace(-5, 5, 100)
         ys = a * (b ** xs)
 
-        tmp_file = os.path.join('out', str(uuid.uuid4()) + '.png')
-        umpl.create_graph(xs, ys, 6, 6, -6, tmp_file)
-
+        assets = []
         problem_code = tex.prompt_and_equation(
             '\\Large{\\vspace{0.8em}Look at the graph of an '
             + 'exponential function that '
@@ -40,15 +41,16 @@ class ExpoQualitativeTask(task.Task):
             + 'following statements about this function must be true? '
             + 'Select all that apply.}',
 
-            tex.figure_left_of_text(
-                tmp_file,
+            graphs.graph_left_of_text(
+                self.graph_backend, xs, ys, 6, 6, -6,
                 tex.enumer([
                     '$a$ is positive',
                     '$0 < b < 1$',
                     'the function models growth',
                     'the function models decay',
                     'the range is $y > 0$',
-                ])
+                ]),
+                assets
             ),
             style,
             '-0.4cm'  # adjust space between main prompt and image
@@ -71,9 +73,8 @@ class ExpoQualitativeTask(task.Task):
 
         answer = ', '.join(correct)
 
-        writer = io.StringIO()
-        tex.generate_task(writer, problem_code, answer, '-1.35cm', style)
-        return writer.getvalue()
+        return card.Card(problem_code, answer, '-1.35cm', style, assets,
+                         self.imports, self.preambles)
 
     @property
     def task_categories(self):
@@ -81,4 +82,14 @@ class ExpoQualitativeTask(task.Task):
 
     @property
     def imports(self):
-        return {'amsmath', 'wrapfig', 'enumitem'}
+        return ({'amsmath', 'wrapfig', 'enumitem'}
+                | graphs.imports(self.graph_backend))
+
+    @property
+    def preambles(self):
+        return graphs.preambles(self.graph_backend)
+
+
+class ExpoQualitativePgfTask(ExpoQualitativeTask):
+    """ExpoQualitativeTask with the graph drawn inline by pgfplots"""
+    graph_backend = 'pgf'
@@ -4,10 +4,8 @@ y = 2x + 1
 """
 import task_cards.utils.tex as tex
 import task_cards.tasks.task as task
-import task_cards.utils.mpl as mpl
-from task_cards.utils.upload import upload
+import task_cards.utils.card as card
 import random
-import io
 import numpy as np
 
 
@@ -18,18 +16,16 @@ MAX_B = 2
 
 class LinearPlotTask(task.Task):
     def generate(self, style=tex.TaskStyle.Minimal):
+        return self.generate_card(style).render()
+
+    def generate_card(self, style=tex.TaskStyle.Minimal):
         m = random.randint(MIN_M, MAX_M)
         b = random.randint(MIN_B, MAX_B)
 
         xs = (-3, 3)
         ys = (-3 * m + b, 3 * m + b)
 
-        img_bytes = io.BytesIO()
-        mpl.create_graph(
-            xs, ys, 5, 5, -5, img_bytes,
-            format='png'
-        )
-        answer = upload(img_bytes)
+        graph = card.UploadedGraph(xs, ys, 5, 5, -5)
 
         if b > 0:
             signed_b = '+' + str(b)
@@ -51,11 +47,11 @@ class LinearPlotTask(task.Task):
             style
         )
 
-        writer = io.StringIO()
-        print(tex.color('.', 'white'), file=writer)
-        print('\\\\', file=writer)  # fix issue created making images work
-        tex.generate_task(writer, problem_code, answer, '2cm', style)
-        return writer.getvalue()
+        # fix issue created making images work
+        problem_code = '\n'.join([tex.color('.', 'white'), '\\\\',
+                                  problem_code])
+        return card.Card(problem_code, graph.placeholder, '2cm', style,
+                         [graph], self.imports, self.preambles)
 
     @property
     def task_categories(self):
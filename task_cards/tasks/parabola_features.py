@@ -3,10 +3,8 @@ import task_cards.tasks.task as task
 import task_cards.utils.tex as tex
 import random
 import numpy as np
-import task_cards.utils.mpl as umpl
-import uuid
-import os
-import io
+import task_cards.utils.graphs as graphs
+import task_cards.utils.card as card
 import enum
 
 
@@ -28,7 +26,12 @@ FEATURE_TO_QN = {
 
 
 class ParabolaFeaturesTask(task.Task):
+    graph_backend = 'mpl'  # see task_cards.utils.graphs
+
     def generate(self, style=tex.TaskStyle.Minimal):
+        return self.generate_card(style).render()
+
+    def generate_card(self, style=tex.TaskStyle.Minimal):
         a_pos = random.random() < 0.5
         a_bigger_one = random.random() < 0.5
         which_feature = random.choice(list(Feature))
@@ -73,24 +76,22 @@ class ParabolaFeaturesTask(task.Task):
             ys = (a * xs**2) + (b * xs) + c
             answer = f'The y-intercept is {c}.'
 
-        tmp_file = os.path.join('out', str(uuid.uuid4()) + '.png')
-        umpl.create_graph(xs, ys, 6, 6, -6, tmp_file)
-
+        assets = []
         problem_code = tex.prompt_and_equation(
             '\\Large{\\vspace{0.8em}Look at this graph of a '
             + 'quadratic function and answer the question. }',
 
-            tex.figure_left_of_text(
-                tmp_file,
-                FEATURE_TO_QN[which_feature]
+            graphs.graph_left_of_text(
+                self.graph_backend, xs, ys, 6, 6, -6,
+                FEATURE_TO_QN[which_feature],
+                assets
             ),
             style,
             '0.2cm'   # adjusts space between main prompt and image
         )
 
-        writer = io.StringIO()
-        tex.generate_task(writer, problem_code, answer, '-1.5cm', style)
-        return writer.getvalue()
+        return card.Card(problem_code, answer, '-1.5cm', style, assets,
+                         self.imports, self.preambles)
 
     @property
     def task_categories(self):
@@ -98,4 +99,14 @@ class ParabolaFeaturesTask(task.Task):
 
     @property
     def imports(self):
-        return {'amsmath', 'wrapfig', 'enumitem'}
+        return ({'amsmath', 'wrapfig', 'enumitem'}
+                | graphs.imports(self.graph_backend))
+
+    @property
+    def preambles(self):
+        return graphs.preambles(self.graph_backend)
+
+
+class ParabolaFeaturesPgfTask(ParabolaFeaturesTask):
+    """ParabolaFeaturesTask with the graph drawn inline by pgfplots"""
+    graph_backend = 'pgf'
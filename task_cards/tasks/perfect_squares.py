@@ -2,16 +2,26 @@
 """
 import task_cards.utils.tex as tex
 import task_cards.tasks.task as task
-import random
+import task_cards.utils.params as params
 import io
 
 MIN_SQRT = 2
 MAX_SQRT = 20
 
+SQRTS = params.ParamSpace(
+    'perfect_squares', [(sqrt,) for sqrt in range(MIN_SQRT, MAX_SQRT + 1)])
+
 
 class PerfectSquaresTask(task.Task):
     def generate(self, style=tex.TaskStyle.Minimal):
-        sqrt = random.randint(MIN_SQRT, MAX_SQRT)
+        sqrt, = SQRTS.draw()
+        return self._card(sqrt, style)
+
+    def generate_batch(self, n, rng, style=tex.TaskStyle.Minimal):
+        return [self._card(sqrt, style)
+                for sqrt, in SQRTS.draw_batch(n, rng)]
+
+    def _card(self, sqrt, style):
         square = sqrt * sqrt
 
         problem_code = tex.prompt_and_equation(
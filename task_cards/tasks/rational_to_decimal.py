@@ -3,8 +3,14 @@ whether it repeats or terminates.
 """
 import task_cards.utils.tex as tex
 import task_cards.tasks.task as task
+import task_cards.utils.params as params
+import task_cards.utils.primes as primes
 import random
 import io
+import collections
+import itertools
+import math
+import typing
 import numpy as np
 from fractions import Fraction
 
@@ -13,45 +19,80 @@ MAX_NUM = 150
 
 NOISE_PRIMES = [3, 7, 9, 11, 13, 17, 19]
 
+TERMINATING_DENOMS = params.ParamSpace('rational_terminating', [
+    (2 ** pows_2 * 5 ** pows_5,)
+    for pows_2 in range(0, 6)
+    for pows_5 in range(0, 3)
+    if MIN_NUM <= 2 ** pows_2 * 5 ** pows_5 <= MAX_NUM
+])
+"""Denominators of terminating decimals, one per valid (powers of 2,
+powers of 5) pair"""
+
+
+def _repeating_denom_weights() -> typing.Dict[int, float]:
+    """Returns the probability of each denominator of a repeating decimal
+    when drawing 0-2 factors from 2 and 5 (with probabilities 0.5, 0.35 and
+    0.15) and 1-3 factors from NOISE_PRIMES, given the denominator is
+    within MIN_NUM and MAX_NUM"""
+    res = collections.defaultdict(float)
+    for num_non_noise, non_noise_prob in ((0, 0.5), (1, 0.35), (2, 0.15)):
+        for non_noise_ps in itertools.product([2, 5], repeat=num_non_noise):
+            for num_noise in range(1, 4):
+                prob = non_noise_prob * (0.5 ** num_non_noise) / 3
+                prob /= len(NOISE_PRIMES) ** num_noise
+                for noise_ps in itertools.product(NOISE_PRIMES,
+                                                  repeat=num_noise):
+                    denom = math.prod(non_noise_ps) * math.prod(noise_ps)
+                    if MIN_NUM <= denom <= MAX_NUM:
+                        res[denom] += prob
+    return res
+
+
+_REPEATING_WEIGHTS = _repeating_denom_weights()
+REPEATING_DENOMS = params.ParamSpace(
+    'rational_repeating',
+    [(denom,) for denom in _REPEATING_WEIGHTS],
+    _REPEATING_WEIGHTS.values()
+)
+"""Denominators of repeating decimals, weighted by how likely the factors
+that make them up are"""
+
+
 class RationalToDecimalTask(task.Task):
     def generate(self, style=tex.TaskStyle.Minimal):
         should_terminate = random.random() < .5
         is_positive = random.random() < .5
 
         if should_terminate:
-            denom = 0
-            while denom < MIN_NUM or denom > MAX_NUM:
-                de_pows_2 = random.randint(0, 5)
-                de_pows_5 = random.randint(0, 2)
-
-                denom = 1
-                denom *= 2 ** de_pows_2
-                denom *= 5 ** de_pows_5
-
-            num = random.randint(MIN_NUM, MAX_NUM)
+            denom, = TERMINATING_DENOMS.draw()
         else:
-            denom = 0
+            denom, = REPEATING_DENOMS.draw()
+        num = random.randint(MIN_NUM, MAX_NUM)
 
-            while denom < MIN_NUM or denom > MAX_NUM:
-                denom = 1
-                non_noise = int(np.random.choice(
-                    [0, 1, 2], size=(1,), replace=True,
-                    p=[0.5, 0.35, 0.15]
-                ))
+        return self._card(num, denom, should_terminate, is_positive, style)
 
-                if non_noise > 0:
-                    non_noise_ps = np.random.choice(
-                        [2, 5], size=(non_noise,), replace=True)
-                    for p in non_noise_ps:
-                        denom *= int(p)
+    def generate_batch(self, n, rng, style=tex.TaskStyle.Minimal):
+        should_terminate = rng.random(n) < .5
+        is_positive = rng.random(n) < .5
+        nums = rng.integers(MIN_NUM, MAX_NUM + 1, size=n)
 
-                num_noise_ps = random.randint(1, 3)
-                noise_ps = np.random.choice(NOISE_PRIMES, size=(num_noise_ps,))
-                for p in noise_ps:
-                    denom *= int(p)
+        denoms = np.empty(n, dtype=np.int64)
+        num_terminate = int(should_terminate.sum())
+        denoms[should_terminate] = [
+            denom for denom, in TERMINATING_DENOMS.draw_batch(
+                num_terminate, rng)]
+        denoms[~should_terminate] = [
+            denom for denom, in REPEATING_DENOMS.draw_batch(
+                n - num_terminate, rng)]
 
-            num = random.randint(MIN_NUM, MAX_NUM)
+        return [
+            self._card(num, denom, terminate, positive, style)
+            for num, denom, terminate, positive in zip(
+                nums.tolist(), denoms.tolist(), should_terminate.tolist(),
+                is_positive.tolist())
+        ]
 
+    def _card(self, num, denom, should_terminate, is_positive, style):
         eqn = '-' if not is_positive else ''
         eqn += '\\frac{%s}{%s}' % (num, denom)
         problem_code = tex.prompt_and_equation(
@@ -61,7 +102,9 @@ class RationalToDecimalTask(task.Task):
             tex.scale_eqn(f'${eqn}$', '2'),
             style
         )
-        answer = f'{num/denom}, ' + ('terminates' if should_terminate else 'repeats')
+        # the fraction may reduce to one with a terminating denominator
+        terminates = primes.terminates(Fraction(num, denom).denominator)
+        answer = f'{num/denom}, ' + ('terminates' if terminates else 'repeats')
 
         writer = io.StringIO()
         print(tex.color('.', 'white'), file=writer)
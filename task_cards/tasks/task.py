@@ -2,6 +2,7 @@
 import typing
 import enum
 import task_cards.utils.tex as tex
+import task_cards.utils.card as card
 
 
 class TaskCategory(enum.IntEnum):
@@ -26,6 +27,40 @@ class Task:
         """
         raise NotImplementedError
 
+    def generate_batch(self, n: int, rng,
+                       style: tex.TaskStyle = tex.TaskStyle.Minimal
+                       ) -> typing.List[str]:
+        """Generates n task cards with the given style. Tasks which can draw
+        the parameters for all n cards at once from rng as numpy arrays
+        should override this; by default it calls generate n times, which
+        draws from the global random state instead of rng.
+
+        Arguments:
+            n (int): the number of cards to generate
+            rng (numpy.random.Generator): where to draw the parameters from
+            style (TaskStyle, optional): the style for the cards.
+                Default TaskStyle.Minimal
+        Returns:
+            The latex for each task card
+        """
+        return [self.generate(style) for _ in range(n)]
+
+    def generate_card(self, style: tex.TaskStyle = tex.TaskStyle.Minimal
+                      ) -> card.Card:
+        """Generates the task card with the given style as a Card, whose
+        assets are rendered later together with the rest of the deck. Tasks
+        with slow assets (graphs, uploads) should override this; by default
+        it wraps generate, so the card is already complete.
+
+        Arguments:
+            style (TaskStyle, optional): the style for the card.
+                Default TaskStyle.Minimal
+        Returns:
+            The task card
+        """
+        return card.Card(self.generate(style), style=style,
+                         imports=self.imports, preambles=self.preambles)
+
     @property
     def task_categories(self) -> typing.Set[TaskCategory]:
         """Returns the categories that this task belongs too"""
@@ -1,9 +1,15 @@
 """Adds borders after the fact to task cards"""
+import task_cards.utils.pool as pool
+import task_cards.utils.tracing as tracing
 import PIL
-import PyPDF2
-import pdf2image
-import typing
+import concurrent.futures
+import functools
+import io
 import os
+import struct
+import subprocess
+import time
+import typing
 
 
 def _resize_to_keep_aspect(oldw, oldh, neww, newh):
@@ -15,21 +21,27 @@ def _resize_to_keep_aspect(oldw, oldh, neww, newh):
     return (int(newh * (oldw / oldh)), newh)
 
 
-def add_borders_to_img(img: PIL.Image, border_img='img/border_1.jpg',
-                       margins: typing.Tuple[int, int] = (200, 200)):
-    """Adds the specified border image to the background of the given
-    image, by breaking the border image into 4ths, resizing in the appropriate
-    aspect ratio for each 4th, and dumping onto the appropriate spot
-    """
+@functools.lru_cache(maxsize=8)
+def border_frame(border_img: str,
+                 size: typing.Tuple[int, int]) -> PIL.Image:
+    """Returns a white image of the given size with the border image broken
+    into 4ths, resized in the appropriate aspect ratio for each 4th, and
+    dumped onto the appropriate corner. Frames are cached per border image
+    and size, since every card on a deck has the same size; the returned
+    image is shared and must not be modified.
 
+    Arguments:
+        border_img (str): the path to the border image
+        size (tuple[int, int]): the width and height of the frame
+    """
     border = PIL.Image.open(border_img)
-    target_img = PIL.Image.new('RGB', img.size, 'white')
+    target_img = PIL.Image.new('RGB', size, 'white')
 
     bcs = (border.size[0] // 2, border.size[1] // 2)
     # bcs = border corner size
     new_border_size = _resize_to_keep_aspect(
         bcs[0], bcs[1],
-        img.size[0] // 2, img.size[1] // 2
+        size[0] // 2, size[1] // 2
     )
     nbs = new_border_size
 
@@ -38,14 +50,38 @@ def add_borders_to_img(img: PIL.Image, border_img='img/border_1.jpg',
     target_img.paste(bord, (0, 0))
     bord = (border.crop((bcs[0], 0, bcs[0] * 2, bcs[1]))  # top-right
             .resize(new_border_size, PIL.Image.LANCZOS))
-    target_img.paste(bord, (img.size[0] - nbs[0], 0))
+    target_img.paste(bord, (size[0] - nbs[0], 0))
     bord = (border.crop((0, bcs[1], bcs[0], bcs[1] * 2))  # bottom-left
             .resize(new_border_size, PIL.Image.LANCZOS))
-    target_img.paste(bord, (0, img.size[1] - nbs[1]))
+    target_img.paste(bord, (0, size[1] - nbs[1]))
     bord = (border.crop((bcs[0], bcs[1], bcs[0] * 2, bcs[1] * 2))  # bot-right
             .resize(new_border_size, PIL.Image.LANCZOS))
-    target_img.paste(bord, (img.size[0] - nbs[0], img.size[1] - nbs[1]))
+    target_img.paste(bord, (size[0] - nbs[0], size[1] - nbs[1]))
+    return target_img
+
+
+def save_border_frame(filename: str, border_img='img/border_1.jpg',
+                      size: typing.Tuple[int, int] = (1650, 1275)):
+    """Saves the border frame for a single card, for documents which draw
+    the border themselves (see tex.border_preamble) instead of going
+    through add_borders.
+
+    Arguments:
+        filename (str): where to save the frame
+        border_img (str, optional): the path to the border image
+        size (tuple[int, int], optional): the size of the frame. Default is
+            a quarter of a landscape letter page at 300 DPI
+    """
+    border_frame(border_img, size).save(filename)
+
 
+def add_borders_to_img(img: PIL.Image, border_img='img/border_1.jpg',
+                       margins: typing.Tuple[int, int] = (200, 200)):
+    """Adds the specified border image to the background of the given
+    image, by copying the cached border frame for the image size and
+    pasting the image, shrunk by the margins, on top of it
+    """
+    target_img = border_frame(border_img, img.size).copy()
     target_img.paste(
         img.resize((img.size[0] - margins[0] * 2,
                     img.size[1] - margins[1] * 2), PIL.Image.LANCZOS),
@@ -54,42 +90,412 @@ def add_borders_to_img(img: PIL.Image, border_img='img/border_1.jpg',
     return target_img
 
 
-def add_borders(pdf: str, final_pdf: str, num_pages: int):
-    """Loads the PDF and exports to a PNG with pretty borders"""
-    without_ext = os.path.splitext(pdf)[0]
-    png = without_ext + '.png'
-    pdfs = []
-    for page in range(num_pages):
-        out_pdf = f'{without_ext}_{page}.pdf'
-        pdf2image.convert_from_path(
-            pdf, dpi=300, first_page=page+1, last_page=page+1)[0].save(png)
-
-        img = PIL.Image.open(png)
-        width, height = img.size
-
-        w_o_2 = width // 2
-        h_o_2 = height // 2
-
-        cards = [
-            img.crop((0, 0, w_o_2, h_o_2)),
-            img.crop((w_o_2, 0, width, h_o_2)),
-            img.crop((0, h_o_2, w_o_2, height)),
-            img.crop((w_o_2, h_o_2, width, height))
-        ]
-
-        for i in range(4):
-            cards[i] = add_borders_to_img(cards[i])
-
-        tar_img = PIL.Image.new('RGB', (width, height), 'white')
-        tar_img.paste(cards[0], (0, 0))
-        tar_img.paste(cards[1], (w_o_2, 0))
-        tar_img.paste(cards[2], (0, h_o_2))
-        tar_img.paste(cards[3], (w_o_2, h_o_2))
-        tar_img.save(out_pdf)
-        pdfs.append(out_pdf)
-
-    merger = PyPDF2.PdfFileMerger()
-    for pdf in pdfs:
-        merger.append(pdf)
-    merger.write(final_pdf)
-    merger.close()
+def _border_page(img: PIL.Image) -> PIL.Image:
+    """Splits a rasterized page into its 4 cards, adds the border to each
+    of them and reassembles them into a page of the same size"""
+    with tracing.span('border page'):
+        page = _border_cards(img)
+    tracing.flush()  # pool workers are not told when the pool shuts down
+    return page
+
+
+def _border_cards(img: PIL.Image) -> PIL.Image:
+    return assemble_page([add_borders_to_img(card)
+                          for card in split_page(img)])
+
+
+def split_page(img: PIL.Image) -> typing.List[PIL.Image]:
+    """Splits a rasterized page into its 4 cards, top-left, top-right,
+    bottom-left and bottom-right"""
+    width, height = img.size
+
+    w_o_2 = width // 2
+    h_o_2 = height // 2
+
+    return [
+        img.crop((0, 0, w_o_2, h_o_2)),
+        img.crop((w_o_2, 0, width, h_o_2)),
+        img.crop((0, h_o_2, w_o_2, height)),
+        img.crop((w_o_2, h_o_2, width, height))
+    ]
+
+
+def assemble_page(cards: typing.List[PIL.Image]) -> PIL.Image:
+    """Reassembles the 4 cards from split_page into a page"""
+    w_o_2, h_o_2 = cards[0].size
+    width = w_o_2 + cards[1].size[0]
+    height = h_o_2 + cards[2].size[1]
+
+    tar_img = PIL.Image.new('RGB', (width, height), 'white')
+    tar_img.paste(cards[0], (0, 0))
+    tar_img.paste(cards[1], (w_o_2, 0))
+    tar_img.paste(cards[2], (0, h_o_2))
+    tar_img.paste(cards[3], (w_o_2, h_o_2))
+    return tar_img
+
+
+def _border_split_page(img: PIL.Image) -> typing.List[PIL.Image]:
+    """Splits a rasterized page into its 4 cards and adds the border to
+    each of them"""
+    with tracing.span('border page'):
+        cards = [add_borders_to_img(card) for card in split_page(img)]
+    tracing.flush()  # pool workers are not told when the pool shuts down
+    return cards
+
+
+def write_pdf(final_pdf: str, pages: typing.Iterable[PIL.Image]):
+    """Writes the pages to a single pdf in one pass. Each page is encoded
+    as a jpeg, like PIL's pdf writer does, and written to the file as soon
+    as it arrives, so only one page is ever held in memory. The page tree
+    and cross-reference table are written last, once all pages are known.
+    """
+    date = time.gmtime()
+    if 'SOURCE_DATE_EPOCH' in os.environ:  # reproducible builds
+        date = time.gmtime(int(os.environ['SOURCE_DATE_EPOCH']))
+    date = _pdf_string(time.strftime('D:%Y%m%d%H%M%SZ', date))
+    title = _pdf_string(os.path.splitext(os.path.basename(final_pdf))[0])
+
+    with open(final_pdf, 'wb') as outfile:
+        writer = _PdfWriter(outfile)
+        pages_id = writer.reserve()
+        page_ids = []
+        for page in pages:
+            with tracing.span('write pdf'):
+                if page.mode != 'RGB':  # converting always copies
+                    page = page.convert('RGB')
+                page_ids.append(_write_pdf_page(writer, pages_id, page))
+
+        kids = b' '.join(b'%d 0 R' % page_id for page_id in page_ids)
+        writer.write_obj(b'/Type /Pages /Count %d /Kids [%s]'
+                         % (len(page_ids), kids), obj_id=pages_id)
+        root_id = writer.write_obj(b'/Type /Catalog /Pages %d 0 R'
+                                   % pages_id)
+        info_id = writer.write_obj(b'/Title %s /CreationDate %s /ModDate %s'
+                                   % (title, date, date))
+        writer.write_xref_and_trailer(root_id, info_id)
+
+
+def _write_pdf_page(writer: '_PdfWriter', pages_id: int,
+                    img: PIL.Image) -> int:
+    """Writes the image as a page of 1 point per pixel, the default of
+    PIL's pdf writer. Returns the object number of the page"""
+    encoded = io.BytesIO()
+    img.save(encoded, 'JPEG')
+    width, height = img.size
+    image_id = writer.write_obj(
+        b'/Type /XObject /Subtype /Image /Width %d /Height %d '
+        b'/Filter /DCTDecode /BitsPerComponent 8 /ColorSpace /DeviceRGB'
+        % (width, height), stream=encoded.getvalue())
+    contents_id = writer.write_obj(
+        b'', stream=b'q %d 0 0 %d 0 0 cm /image Do Q\n' % (width, height))
+    return writer.write_obj(
+        b'/Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] '
+        b'/Resources << /ProcSet [/PDF /ImageC] '
+        b'/XObject << /image %d 0 R >> >> /Contents %d 0 R'
+        % (pages_id, width, height, image_id, contents_id))
+
+
+def _pdf_string(text: str) -> bytes:
+    """Returns the text as a pdf string, utf-16 if it is not ascii"""
+    if not text.isascii():
+        encoded = b'\xfe\xff' + text.encode('utf-16-be')  # with a bom
+        return b'<%s>' % encoded.hex().encode('ascii')
+    escaped = text.replace('\\', '\\\\').replace('(', '\\(')
+    return b'(%s)' % escaped.replace(')', '\\)').encode('ascii')
+
+
+class _PdfWriter:
+    """Writes the objects of a pdf one after another, remembering where
+    each starts for the cross-reference table. Each object is a dictionary,
+    optionally followed by a stream"""
+    def __init__(self, outfile: typing.BinaryIO):
+        self.outfile = outfile
+        self.offsets = dict()  # object number -> byte offset
+        self.next_id = 1
+        # binary bytes in the comment tell tools that the file is binary
+        outfile.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def reserve(self) -> int:
+        """Returns the number of an object to be written later, so that
+        objects written before can refer to it"""
+        self.next_id += 1
+        return self.next_id - 1
+
+    def write_obj(self, entries: bytes, stream: bytes = None,
+                  obj_id: int = None) -> int:
+        """Writes an object and returns its number
+
+        Arguments:
+            entries (bytes): the entries of the dictionary, without << >>
+            stream (bytes, optional): the data of the stream. Default none
+            obj_id (int, optional): the number from reserve. Default a new
+                number
+        """
+        if obj_id is None:
+            obj_id = self.reserve()
+        self.offsets[obj_id] = self.outfile.tell()
+        if stream is not None:
+            entries += b' /Length %d' % len(stream)
+        self.outfile.write(b'%d 0 obj\n<< %s >>\n' % (obj_id, entries))
+        if stream is not None:
+            self.outfile.write(b'stream\n%s\nendstream\n' % stream)
+        self.outfile.write(b'endobj\n')
+        return obj_id
+
+    def write_xref_and_trailer(self, root_id: int, info_id: int):
+        """Ends the pdf with the table of where each object starts"""
+        start = self.outfile.tell()
+        lines = [b'xref\n0 %d\n' % self.next_id, b'0000000000 65535 f \n']
+        lines += [b'%010d 00000 n \n' % self.offsets[obj_id]
+                  for obj_id in range(1, self.next_id)]
+        lines.append(b'trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\n'
+                     % (self.next_id, root_id, info_id))
+        lines.append(b'startxref\n%d\n%%%%EOF\n' % start)
+        self.outfile.write(b''.join(lines))
+
+
+class Rasterizer:
+    """Converts the pages of a pdf into images, streaming them out in
+    page order"""
+    def pages(self, pdf: str, num_pages: int) -> typing.Iterator[PIL.Image]:
+        """Rasterizes the first num_pages pages of the pdf
+
+        Arguments:
+            pdf (str): the path to the pdf
+            num_pages (int): the number of pages to rasterize
+        Returns:
+            An iterator over the page images, in page order
+        """
+        raise NotImplementedError
+
+
+class PdftoppmRasterizer(Rasterizer):
+    """Rasterizes with poppler's pdftoppm, reading the pages from its
+    output as they are written instead of collecting them through
+    pdf2image. With one job a single pdftoppm process renders every page,
+    so the document is parsed once. With jobs > 1 the pages are split into
+    contiguous ranges of at most range_pages pages, of which jobs are
+    rendered at once by concurrent processes; the first range is streamed
+    and the ones ahead are kept as png, which is far smaller than the raw
+    pages, until they are reached. The next range is only started once one
+    is reached, so at most jobs ranges are held however long the deck.
+    """
+    def __init__(self, dpi: int = 300, jobs: int = 1,
+                 range_pages: int = 8):
+        self.dpi = dpi
+        self.jobs = jobs
+        self.range_pages = range_pages
+
+    def _start(self, pdf: str, first: int, last: int,
+               png: bool = False) -> subprocess.Popen:
+        """Starts rendering pages first to last (exclusive, 0-indexed) to
+        the stdout of a pdftoppm process"""
+        args = ['pdftoppm', '-r', str(self.dpi),
+                '-f', str(first + 1), '-l', str(last)]
+        if png:
+            args.append('-png')
+        args.append(pdf)
+        return subprocess.Popen(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+
+    def pages(self, pdf: str, num_pages: int) -> typing.Iterator[PIL.Image]:
+        if num_pages < 1:
+            return
+        jobs = max(1, min(self.jobs, num_pages))
+        if jobs == 1:
+            size = num_pages
+        else:
+            size = min(-(-num_pages // jobs), self.range_pages)
+        bounds = list(range(0, num_pages, size)) + [num_pages]
+        ranges = list(zip(bounds, bounds[1:]))
+
+        procs = []
+        # pdftoppm runs in its own process, so threads are enough here
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs) as executor:
+            def start(i):
+                proc = self._start(pdf, *ranges[i], png=i > 0)
+                procs.append(proc)
+                if i > 0:
+                    return proc, executor.submit(_read_pngs, proc)
+                return proc, None
+
+            try:
+                ahead = [start(i) for i in range(min(jobs, len(ranges)))]
+                proc, _ = ahead.pop(0)
+                while True:
+                    with tracing.span('rasterize'):
+                        img = _read_ppm(proc.stdout)
+                    if img is None:
+                        break
+                    yield img
+                _check_exit(proc, pdf)
+
+                for i in range(1, len(ranges)):
+                    if i + jobs - 1 < len(ranges):
+                        ahead.append(start(i + jobs - 1))
+                    proc, future = ahead.pop(0)
+                    for data in future.result():
+                        with tracing.span('rasterize'):
+                            img = PIL.Image.open(io.BytesIO(data))
+                            img = img.convert('RGB')
+                        yield img
+                    _check_exit(proc, pdf)
+            finally:
+                for proc in procs:  # if the caller stopped early
+                    if proc.poll() is None:
+                        proc.kill()
+                    proc.wait()
+                    proc.stdout.close()
+
+
+def _read_ppm(stream: typing.BinaryIO) -> typing.Optional[PIL.Image]:
+    """Reads the next image from a stream of binary ppm images, as written
+    by pdftoppm. Returns None at the end of the stream"""
+    header = []
+    while len(header) < 4:  # magic, width, height and maximum value
+        line = stream.readline()
+        if not line:
+            if header:
+                raise ValueError('truncated ppm header')
+            return None
+        header += line.split(b'#', 1)[0].split()
+    width, height = int(header[1]), int(header[2])
+    data = stream.read(width * height * 3)
+    if len(data) < width * height * 3:
+        raise ValueError('truncated ppm image')
+    return PIL.Image.frombytes('RGB', (width, height), data)
+
+
+def _read_pngs(proc: subprocess.Popen) -> typing.List[bytes]:
+    """Reads every png written to the stdout of the process, splitting the
+    stream at the end of each image"""
+    images = []
+    while True:
+        signature = proc.stdout.read(8)
+        if not signature:
+            return images
+        parts = [signature]
+        kind = None
+        while kind != b'IEND':
+            head = proc.stdout.read(8)
+            if len(head) < 8:
+                raise ValueError('truncated png')
+            length, kind = struct.unpack('>I4s', head)
+            parts += [head, proc.stdout.read(length + 4)]  # data and crc
+        images.append(b''.join(parts))
+
+
+def _check_exit(proc: subprocess.Popen, pdf: str):
+    """Raises if pdftoppm failed, once its output has been read"""
+    if proc.wait() != 0:
+        raise RuntimeError(
+            f'pdftoppm failed with exit code {proc.returncode} on {pdf}')
+
+
+class PyMuPDFRasterizer(Rasterizer):
+    """Rasterizes with PyMuPDF, which opens the document once and renders
+    its pages one after another in process. Requires the optional PyMuPDF
+    package.
+    """
+    def __init__(self, dpi: int = 300):
+        import fitz  # optional dependency, only needed for this rasterizer
+        self._fitz = fitz
+        self.dpi = dpi
+
+    def pages(self, pdf: str, num_pages: int) -> typing.Iterator[PIL.Image]:
+        zoom = self.dpi / 72
+        matrix = self._fitz.Matrix(zoom, zoom)
+        with self._fitz.open(pdf) as doc:
+            for page in range(num_pages):
+                with tracing.span('rasterize'):
+                    pix = doc[page].get_pixmap(matrix=matrix, alpha=False)
+                    img = PIL.Image.frombytes(
+                        'RGB', (pix.width, pix.height), pix.samples)
+                yield img
+
+
+RASTERIZERS = {
+    'pdf2image': PdftoppmRasterizer,  # the name from when pdf2image ran it
+    'pymupdf': PyMuPDFRasterizer
+}
+
+
+def add_borders(pdf: str, final_pdf: str, num_pages: int, jobs: int = 1,
+                rasterizer: Rasterizer = None):
+    """Loads the PDF and exports to a PDF with pretty borders. Pages are
+    kept in memory rather than round-tripping through temporary files.
+
+    Arguments:
+        pdf (str): the path to the pdf without borders
+        final_pdf (str): where to write the bordered pdf
+        num_pages (int): the number of pages in the pdf
+        jobs (int, optional): the number of processes that border pages
+            concurrently. Default 1
+        rasterizer (Rasterizer, optional): converts the pdf pages to
+            images. Default PdftoppmRasterizer with the same number of jobs
+    """
+    if jobs <= 1:
+        write_pdf(final_pdf, bordered_pages(pdf, num_pages, 1, rasterizer))
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pages = bordered_pages(pdf, num_pages, jobs, rasterizer, executor)
+        write_pdf(final_pdf, pages)
+
+
+def bordered_pages(pdf: str, num_pages: int, jobs: int = 1,
+                   rasterizer: Rasterizer = None,
+                   executor: concurrent.futures.Executor = None
+                   ) -> typing.Iterator[PIL.Image]:
+    """Yields the pages of the PDF in order with borders added. See
+    add_borders for the arguments.
+
+    Arguments:
+        executor (Executor, optional): a process pool to border the pages
+            in, keeping jobs * 2 pages in flight. Default is to border them
+            in this process
+    """
+    if rasterizer is None:
+        rasterizer = PdftoppmRasterizer(jobs=jobs)
+    rasterized = rasterizer.pages(pdf, num_pages)
+
+    if executor is None:
+        yield from map(_border_page, rasterized)
+        return
+    yield from pool.ordered_map(executor, _border_page, rasterized, jobs * 2)
+
+
+def bordered_cards(pdf: str, num_pages: int, jobs: int = 1,
+                   rasterizer: Rasterizer = None
+                   ) -> typing.Iterator[PIL.Image]:
+    """Yields every card of the PDF in order with its border added, for
+    callers which handle the cards individually. See add_borders for the
+    arguments.
+    """
+    if rasterizer is None:
+        rasterizer = PdftoppmRasterizer(jobs=jobs)
+    rasterized = rasterizer.pages(pdf, num_pages)
+
+    if jobs <= 1:
+        for img in rasterized:
+            yield from _border_split_page(img)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for cards in pool.ordered_map(executor, _border_split_page,
+                                      rasterized, jobs * 2):
+            yield from cards
+
+
+def write_card_pages(final_pdf: str,
+                     pages: typing.Iterable[typing.List[PIL.Image]]):
+    """Assembles the bordered cards of each page, 4 at a time, and writes
+    the pages to a pdf like add_borders does.
+
+    Arguments:
+        final_pdf (str): where to write the pdf
+        pages (iterable[list[PIL.Image]]): the cards of each page in the
+            order of split_page
+    """
+    write_pdf(final_pdf, map(assemble_page, pages))
@@ -0,0 +1,187 @@
+"""A structured result for a task card, whose slow parts are described
+rather than done while the card is generated.
+
+A Card holds the problem and answer latex of a card, and the assets they
+need: graphs to render, graphs to upload. The latex refers to each asset
+by a placeholder. The runner collects the assets of every card in a deck,
+renders each distinct asset once in a single batched stage and only then
+writes the cards as latex, substituting the placeholders.
+"""
+import task_cards.utils.tex as tex
+import task_cards.utils.tracing as tracing
+import task_cards.utils.upload as upload
+import concurrent.futures
+import hashlib
+import io
+import os
+import re
+import typing
+
+_PLACEHOLDER_RE = re.compile(r'@@asset:([0-9a-f]+)@@')
+
+
+class Asset:
+    """Something a card needs rendered before it can be written as latex.
+    Assets with the same key are rendered once per deck."""
+    __slots__ = ()
+
+    def key(self) -> str:
+        """Returns a hash identifying what render produces"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """Does the work and returns the latex the placeholder stands for.
+        May return upload placeholders, see upload.deferred"""
+        raise NotImplementedError
+
+    @property
+    def placeholder(self) -> str:
+        """The text standing in for the asset in the latex of a card"""
+        return f'@@asset:{self.key()}@@'
+
+
+class Graph(Asset):
+    """A graph rendered with mpl.cached_graph. Renders to the file name of
+    the graph, for use with tex.figure"""
+    __slots__ = ('x', 'y', 'width', 'height', 'ymin')
+
+    def __init__(self, x, y, width: int, height: int, ymin: int):
+        """See mpl.create_graph for the arguments"""
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.ymin = ymin
+
+    def key(self) -> str:
+        import numpy as np  # graphs are sampled with numpy anyway
+        hasher = hashlib.sha256()
+        hasher.update(type(self).__name__.encode('utf-8'))
+        hasher.update(np.asarray(self.x, dtype=np.float64).tobytes())
+        hasher.update(b'|')
+        hasher.update(np.asarray(self.y, dtype=np.float64).tobytes())
+        hasher.update(repr((self.width, self.height, self.ymin))
+                      .encode('utf-8'))
+        return hasher.hexdigest()[:32]
+
+    def render(self) -> str:
+        import task_cards.utils.mpl as umpl  # slow to import
+        return os.path.basename(umpl.cached_graph(
+            self.x, self.y, self.width, self.height, self.ymin))
+
+
+class UploadedGraph(Graph):
+    """A graph rendered as a png and uploaded. Renders to its permalink"""
+    __slots__ = ()
+
+    def render(self) -> str:
+        import task_cards.utils.mpl as umpl  # slow to import
+        _, img = umpl.cached_graph_bytes(
+            self.x, self.y, self.width, self.height, self.ymin,
+            format='png')
+        return upload.deferred(io.BytesIO(img))
+
+
+class Card:
+    """A task card which has not been written as latex yet"""
+    __slots__ = ('problem', 'answer', 'vspace', 'style', 'assets',
+                 'imports', 'preambles')
+
+    def __init__(self, problem: str, answer: typing.Optional[str] = None,
+                 vspace: str = '2cm',
+                 style: tex.TaskStyle = tex.TaskStyle.Minimal,
+                 assets: typing.Iterable[Asset] = (),
+                 imports: typing.Iterable[str] = (),
+                 preambles: typing.Dict[str, str] = None):
+        """
+        Arguments:
+            problem (str): the latex code that displays the task, with
+                placeholders for its assets
+            answer (str, optional): the answer, which may also contain
+                placeholders. None if problem is already the whole card,
+                ex: for tasks which only implement Task.generate
+            vspace (str, optional): the space between the problem and the
+                answer, see tex.generate_task. Default '2cm'
+            style (TaskStyle, optional): the style for the card
+            assets (iterable[Asset], optional): the assets in the latex
+            imports (iterable[str], optional): the imports the card needs
+            preambles (dict[str, str], optional): the preambles it needs
+        """
+        self.problem = problem
+        self.answer = answer
+        self.vspace = vspace
+        self.style = style
+        self.assets = tuple(assets)
+        self.imports = frozenset(imports)
+        self.preambles = dict() if preambles is None else preambles
+
+    def resolve_uploads(self):
+        """Waits for the uploads of Task.generate style cards, which can
+        only be resolved in the process that started them"""
+        self.problem = upload.resolve(self.problem)
+        if self.answer is not None:
+            self.answer = upload.resolve(self.answer)
+
+    def latex(self, rendered: typing.Dict[str, str]) -> str:
+        """Writes the card as latex
+
+        Arguments:
+            rendered (dict[str, str]): the rendered assets by key, see
+                render_assets
+        """
+        def _replace(match):
+            return rendered[match.group(1)]
+
+        problem = _PLACEHOLDER_RE.sub(_replace, self.problem)
+        if self.answer is None:
+            return problem
+
+        answer = _PLACEHOLDER_RE.sub(_replace, self.answer)
+        writer = io.StringIO()
+        tex.generate_task(writer, problem, answer, self.vspace, self.style)
+        return writer.getvalue()
+
+    def render(self) -> str:
+        """Renders the assets of this card alone and writes it as latex"""
+        return self.latex(render_assets([self]))
+
+
+def _render_resolved(asset: Asset) -> str:
+    """Renders the asset in a pool worker, waiting for its upload"""
+    rendered = upload.resolve(asset.render())
+    tracing.flush()  # workers are not told when the pool shuts down
+    return rendered
+
+
+def render_assets(cards: typing.Iterable[Card], jobs: int = 1,
+                  executor: concurrent.futures.Executor = None
+                  ) -> typing.Dict[str, str]:
+    """Renders every distinct asset of the cards once
+
+    Arguments:
+        cards (iterable[Card]): the cards whose assets to render
+        jobs (int, optional): the number of processes rendering assets.
+            Default 1
+        executor (Executor, optional): a process pool to render the assets
+            in, instead of one created for the call
+    Returns:
+        The rendered assets by key, with uploads resolved
+    """
+    unique = dict()
+    for crd in cards:
+        for asset in crd.assets:
+            unique.setdefault(asset.key(), asset)
+
+    if executor is not None and unique:
+        return dict(zip(unique, executor.map(
+            _render_resolved, unique.values(), chunksize=4)))
+
+    if jobs > 1 and len(unique) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs) as executor:
+            return dict(zip(unique, executor.map(
+                _render_resolved, unique.values(), chunksize=4)))
+
+    # uploads run in the background while the remaining assets render
+    rendered = {key: asset.render() for key, asset in unique.items()}
+    return {key: upload.resolve(text) for key, text in rendered.items()}
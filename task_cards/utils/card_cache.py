@@ -0,0 +1,109 @@
+"""A cache of compiled and bordered cards, so that rebuilding a deck only
+compiles the cards that changed.
+
+A card is identified by the hash of its latex together with everything
+else that decides how it looks: the imports and preambles of the document
+and the border. The cached value is the bordered card image, as it would
+be cut out of a page of the rasterized and bordered pdf. The cache lives in
+a directory on disk which persists between runs and is kept below a size
+limit by evicting the least recently used cards.
+"""
+import PIL.Image
+import hashlib
+import os
+import typing
+
+CACHE_VERSION = 1
+"""Part of every key. Bump when the way cards are rendered changes so that
+stale cards on disk are not reused"""
+
+
+def card_key(card: str, imports: typing.Iterable[str],
+             preambles: typing.Dict[str, str], salt: str = '') -> str:
+    """Returns the hash identifying the rendered card
+
+    Arguments:
+        card (str): the latex of the card, as returned by Task.generate,
+            with uploads resolved
+        imports (iterable[str]): the packages of the document
+        preambles (dict[str, str]): the preambles of the document
+        salt (str, optional): anything else the rendering depends on, ex:
+            the border image and the resolution
+    """
+    hasher = hashlib.sha256()
+    hasher.update(repr((
+        CACHE_VERSION, sorted(imports), sorted(preambles.items()), salt
+    )).encode('utf-8'))
+    hasher.update(b'|')
+    hasher.update(card.encode('utf-8'))
+    return hasher.hexdigest()[:32]
+
+
+class CardCache:
+    """Bordered card images stored on disk by card_key. Reading a card
+    marks it as recently used by touching its file, and evict removes the
+    cards that were used longest ago until the cache fits its size limit.
+    """
+    def __init__(self, directory: str = os.path.join('cache', 'cards'),
+                 max_bytes: int = 1024 * 1024 * 1024):
+        """
+        Arguments:
+            directory (str, optional): where the cards are stored
+            max_bytes (int, optional): the size the cache is evicted down
+                to. Default 1 GiB
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.png')
+
+    def has(self, key: str) -> bool:
+        """Returns if the card is cached, marking it as recently used"""
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def get(self, key: str) -> PIL.Image:
+        """Returns the cached card. Raises KeyError if it is not cached"""
+        try:
+            with PIL.Image.open(self._path(key)) as img:
+                img.load()
+                return img
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def put(self, key: str, img: PIL.Image):
+        """Stores the bordered card image"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        img.save(tmp_path, 'PNG')
+        os.replace(tmp_path, path)  # atomic, so runs can share the cache
+
+    def evict(self):
+        """Deletes the least recently used cards until the cache is no
+        larger than max_bytes"""
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.png'):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
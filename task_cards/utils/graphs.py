@@ -0,0 +1,64 @@
+"""Lets tasks choose how their graphs are drawn:
+
+- 'mpl' renders an image with matplotlib, see task_cards.utils.mpl
+- 'pgf' draws the graph inline with pgfplots, see task_cards.utils.pgf
+
+The backends are imported when first used, so tasks drawing with pgfplots
+never import matplotlib.
+"""
+import task_cards.utils.tex as tex
+import task_cards.utils.card as card
+import typing
+
+BACKENDS = ('mpl', 'pgf')
+
+
+def _check(backend: str):
+    if backend not in BACKENDS:
+        raise ValueError(f'unknown graph backend {backend}')
+
+
+def graph_left_of_text(backend: str, x, y, width: int, height: int,
+                       ymin: int, text: str,
+                       assets: typing.List[card.Asset] = None) -> str:
+    """Returns the latex code for a graph to the left of the text, see
+    tex.figure_left_of_text. See mpl.create_graph for the graph arguments.
+
+    Arguments:
+        backend (str): one of BACKENDS
+        text (str): the latex to the right of the graph
+        assets (list[Asset], optional): if given, a graph which has to be
+            rendered is not rendered now but appended to the assets of the
+            card, and the latex refers to its placeholder
+    """
+    _check(backend)
+    if backend == 'pgf':
+        import task_cards.utils.pgf as pgf
+        return tex.left_of_text(pgf.graph(x, y, width, height, ymin), text)
+
+    if assets is not None:
+        graph = card.Graph(x, y, width, height, ymin)
+        assets.append(graph)
+        return tex.figure_left_of_text(graph.placeholder, text, shared=True)
+
+    import task_cards.utils.mpl as umpl
+    graph_file = umpl.cached_graph(x, y, width, height, ymin)
+    return tex.figure_left_of_text(graph_file, text, shared=True)
+
+
+def imports(backend: str) -> typing.Set[str]:
+    """Returns the imports required by graphs of the backend"""
+    _check(backend)
+    if backend == 'pgf':
+        import task_cards.utils.pgf as pgf
+        return set(pgf.IMPORTS)
+    return {'graphicx'}
+
+
+def preambles(backend: str) -> typing.Dict[str, str]:
+    """Returns the preambles required by graphs of the backend"""
+    _check(backend)
+    if backend == 'pgf':
+        import task_cards.utils.pgf as pgf
+        return dict(pgf.PREAMBLES)
+    return dict()
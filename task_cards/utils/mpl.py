@@ -1,5 +1,123 @@
 """Utility functions related to matplotlib"""
-import matplotlib.pyplot as plt
+import matplotlib
+import matplotlib.figure
+import matplotlib.lines
+import matplotlib.backends.backend_agg as backend_agg
+import numpy as np
+import task_cards.utils.tracing as tracing
+import collections
+import hashlib
+import io
+import os
+import typing
+
+FIGURE_INCHES = 15
+"""The width and height of the figures. Line widths and fonts are sized
+for it, and the graph is scaled down to its size on the card"""
+
+DISPLAY_INCHES = 200 / 72
+"""The size graphs are shown at by tex.figure_left_of_text (200px, where a
+px is a bp in pdflatex)"""
+
+PRINT_DPI = 300
+"""The resolution the decks are rasterized at when they are bordered"""
+
+OUTPUT_MODES = {
+    # 4500x4500 images, much larger than needed
+    'full': ('png', dict()),
+    # images with as many pixels as the printed page has in their place
+    'display': ('png', {'dpi': PRINT_DPI * DISPLAY_INCHES / FIGURE_INCHES}),
+    # vector graphics, which pdflatex embeds without resampling
+    'vector': ('pdf', dict()),
+}
+"""The file format and savefig arguments for each way cached_graph can
+output graphs"""
+
+_OUTPUT_MODE = 'full'
+
+
+def set_output_mode(mode: str):
+    """Chooses how cached_graph outputs graphs, see OUTPUT_MODES"""
+    global _OUTPUT_MODE
+    if mode not in OUTPUT_MODES:
+        raise ValueError(f'unknown output mode {mode}')
+    _OUTPUT_MODE = mode
+
+
+def output_mode() -> str:
+    """Returns how cached_graph outputs graphs, see OUTPUT_MODES"""
+    return _OUTPUT_MODE
+
+
+class GraphRenderer:
+    """Draws graphs onto pre-styled figures which are kept and reused, one
+    per (width, height, ymin) configuration. Only the line data changes
+    between graphs, so the axes, ticks, spines and fonts are built once.
+    The figures are not registered with pyplot, so they are never leaked.
+    """
+    def __init__(self, max_templates: int = 8):
+        """
+        Arguments:
+            max_templates (int, optional): the maximum number of figure
+                configurations to keep around. Default 8
+        """
+        self.max_templates = max_templates
+        self._templates = collections.OrderedDict()
+
+    def _template(self, width: int, height: int, ymin: int) -> typing.Tuple[
+            matplotlib.figure.Figure, matplotlib.lines.Line2D]:
+        """Returns the figure and its line for the given configuration,
+        creating it if it is not already cached"""
+        key = (width, height, ymin)
+        if key in self._templates:
+            self._templates.move_to_end(key)
+            return self._templates[key]
+
+        fig = matplotlib.figure.Figure(
+            figsize=(FIGURE_INCHES, FIGURE_INCHES))
+        backend_agg.FigureCanvasAgg(fig)
+        axes = fig.subplots()
+
+        line, = axes.plot([], [], 'b', linewidth=8)
+        # axes.text(0.15, height - 0.5, 'y')
+        # axes.text(-width + 0.2, 1, 'x')
+        axes.axis([-width, width, ymin, height])
+        axes.tick_params(
+            which='both',
+            width=4,
+            length=8,
+            labelsize=32
+        )
+        axes.set_xticks([i for i in range(-width + 1, width) if i != 0])
+        axes.set_yticks([i for i in range(ymin + 1, height) if i != 0])
+        axes.spines['bottom'].set_position('zero')
+        axes.spines['left'].set_position('zero')
+        axes.spines['top'].set_visible(False)
+        axes.spines['right'].set_visible(False)
+        for item in (axes.title, axes.xaxis.label, axes.yaxis.label):
+            item.set_fontsize(32)
+        for spine in axes.spines.values():
+            spine.set_linewidth(6)
+
+        self._templates[key] = (fig, line)
+        if len(self._templates) > self.max_templates:
+            self._templates.popitem(last=False)
+        return fig, line
+
+    def render(self, x, y, width, height, ymin, filename,
+               **savefig_kwargs):
+        """Draws the graph and saves it. See create_graph"""
+        fig, line = self._template(width, height, ymin)
+        line.set_data(x, y)
+        if 'dpi' not in savefig_kwargs:
+            savefig_kwargs['dpi'] = PRINT_DPI
+        # embed TrueType rather than Type 3 fonts, which pdflatex handles
+        # better and which are smaller
+        with matplotlib.rc_context({'pdf.fonttype': 42}):
+            fig.savefig(filename, **savefig_kwargs)
+
+
+_RENDERER = GraphRenderer()
 
 
 def create_graph(x, y, width, height, ymin, filename,
@@ -16,29 +134,124 @@ def create_graph(x, y, width, height, ymin, filename,
         ymin (float): the minimum y of the plot
         filename (file or str): where to save the plot to
     """
-    fig, axes = plt.subplots(figsize=(15, 15))
-
-    axes.plot(x, y, 'b', linewidth=8)
-    # axes.text(0.15, height - 0.5, 'y')
-    # axes.text(-width + 0.2, 1, 'x')
-    axes.axis([-width, width, ymin, height])
-    axes.tick_params(
-        which='both',
-        width=4,
-        length=8
-    )
-    axes.set_xticks([i for i in range(-width + 1, width) if i != 0])
-    axes.set_yticks([i for i in range(ymin + 1, height) if i != 0])
-    axes.spines['bottom'].set_position('zero')
-    axes.spines['left'].set_position('zero')
-    axes.spines['top'].set_visible(False)
-    axes.spines['right'].set_visible(False)
-    for item in (
-            [axes.title, axes.xaxis.label, axes.yaxis.label] +
-            axes.get_xticklabels() + axes.get_yticklabels()):
-        item.set_fontsize(32)
-    for spine in axes.spines.values():
-        spine.set_linewidth(6)
-    if 'dpi' not in savefig_kwargs:
-        savefig_kwargs['dpi'] = 300
-    plt.savefig(filename, **savefig_kwargs)
+    with tracing.span('create_graph', 'plot'):
+        _RENDERER.render(x, y, width, height, ymin, filename,
+                         **savefig_kwargs)
+
+
+STYLE_VERSION = 1
+"""Part of every graph cache key. Bump when the look of the graphs changes
+so that stale images on disk are not reused"""
+
+
+def graph_key(x, y, width, height, ymin, **savefig_kwargs) -> str:
+    """Returns a hash identifying the image that create_graph would
+    produce for the given arguments"""
+    hasher = hashlib.sha256()
+    hasher.update(np.asarray(x, dtype=np.float64).tobytes())
+    hasher.update(b'|')
+    hasher.update(np.asarray(y, dtype=np.float64).tobytes())
+    hasher.update(repr((
+        STYLE_VERSION, width, height, ymin, sorted(savefig_kwargs.items())
+    )).encode('utf-8'))
+    return hasher.hexdigest()[:32]
+
+
+class GraphCache:
+    """Content-addressed cache of rendered graphs, kept in a bounded
+    in-memory LRU in front of a directory on disk that persists between
+    runs
+    """
+    def __init__(self, directory: str = os.path.join('cache', 'graphs'),
+                 max_memory_items: int = 64):
+        """
+        Arguments:
+            directory (str, optional): where the images are stored on disk
+            max_memory_items (int, optional): the number of images kept in
+                memory. Default 64
+        """
+        self.directory = directory
+        self.max_memory_items = max_memory_items
+        self._memory = collections.OrderedDict()
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.directory, f'{key}.{ext}')
+
+    def get(self, key: str, ext: str = 'png') -> typing.Optional[bytes]:
+        """Returns the cached image or None if it is not cached"""
+        mem_key = (key, ext)
+        if mem_key in self._memory:
+            self._memory.move_to_end(mem_key)
+            return self._memory[mem_key]
+
+        path = self._path(key, ext)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as infile:
+            data = infile.read()
+        self._remember(mem_key, data)
+        return data
+
+    def put(self, key: str, data: bytes, ext: str = 'png'):
+        """Stores the image both in memory and on disk"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key, ext)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(data)
+        os.replace(tmp_path, path)  # atomic, so workers can share the cache
+        self._remember((key, ext), data)
+
+    def _remember(self, mem_key: typing.Tuple[str, str], data: bytes):
+        self._memory[mem_key] = data
+        self._memory.move_to_end(mem_key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+
+_CACHE = GraphCache()
+
+
+def cached_graph_bytes(x, y, width, height, ymin, format='png',
+                       **savefig_kwargs) -> typing.Tuple[str, bytes]:
+    """Returns the key and the image that create_graph would produce for
+    the given arguments, rendering it only if it is not already cached.
+    See create_graph for the arguments.
+    """
+    key = graph_key(x, y, width, height, ymin, format=format,
+                    **savefig_kwargs)
+    data = _CACHE.get(key, format)
+    if data is None:
+        img_bytes = io.BytesIO()
+        create_graph(x, y, width, height, ymin, img_bytes, format=format,
+                     **savefig_kwargs)
+        data = img_bytes.getvalue()
+        _CACHE.put(key, data, format)
+    return key, data
+
+
+def cached_graph(x, y, width, height, ymin, out_dir: str = 'out',
+                 format: str = None, **savefig_kwargs) -> str:
+    """Makes sure the graph for the given arguments exists in out_dir and
+    returns its path. The file is named after the hash of the arguments,
+    so identical graphs share a single file. See create_graph for the
+    remaining arguments.
+
+    Arguments:
+        out_dir (str, optional): the directory to place the graph in,
+            which should be the directory of the tex file. Default 'out'
+        format (str, optional): the file format, ex: 'png' or 'pdf'.
+            Default is to output graphs as chosen by set_output_mode
+    """
+    if format is None:
+        format, defaults = OUTPUT_MODES[_OUTPUT_MODE]
+        savefig_kwargs = {**defaults, **savefig_kwargs}
+    key, data = cached_graph_bytes(x, y, width, height, ymin, format=format,
+                                   **savefig_kwargs)
+    path = os.path.join(out_dir, f'{key}.{format}')
+    if not os.path.exists(path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(data)
+        os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,138 @@
+"""Finite parameter spaces that tasks can declare instead of drawing their
+parameters with rejection loops. The table of valid parameters is built
+once, after which parameters can be sampled in O(1) (weighted with the
+alias method), or drawn without replacement so that a deck works its way
+through the whole space before repeating a card.
+"""
+import task_cards.utils.seeding as seeding
+import random
+import typing
+
+
+class ParamSpace:
+    """A table of valid parameter tuples, optionally weighted"""
+    def __init__(self, name: str, params: typing.Iterable[typing.Tuple],
+                 weights: typing.Iterable[float] = None):
+        """
+        Arguments:
+            name (str): identifies the space, so that different spaces are
+                shuffled differently for the same seed
+            params (iterable[tuple]): every valid parameter tuple
+            weights (iterable[float], optional): the relative weight of each
+                tuple. Default uniform
+        """
+        self.name = name
+        self.params = list(params)
+        if not self.params:
+            raise ValueError(f'parameter space {name} is empty')
+
+        if weights is None:
+            self.probabilities = [1 / len(self.params)] * len(self.params)
+        else:
+            weights = list(weights)
+            if len(weights) != len(self.params):
+                raise ValueError('expected one weight per parameter tuple')
+            total = sum(weights)
+            self.probabilities = [wt / total for wt in weights]
+        self._uniform = weights is None
+        self._pass_len = len(self.params) * (1 if self._uniform else 4)
+        self._build_alias()
+        self._pass_indices = None  # one pass of indices for draw_batch
+        self._seeded_pass = (None, None, None)  # seed, pass, order
+        self._order = []
+        self._pos = 0
+
+    def __len__(self):
+        return len(self.params)
+
+    def _build_alias(self):
+        """Builds the tables for Vose's alias method"""
+        num = len(self.params)
+        scaled = [prob * num for prob in self.probabilities]
+        self._prob = [1.0] * num
+        self._alias = list(range(num))
+        small = [i for i, sc in enumerate(scaled) if sc < 1]
+        large = [i for i, sc in enumerate(scaled) if sc >= 1]
+        while small and large:
+            sm = small.pop()
+            lg = large.pop()
+            self._prob[sm] = scaled[sm]
+            self._alias[sm] = lg
+            scaled[lg] = scaled[lg] + scaled[sm] - 1
+            (small if scaled[lg] < 1 else large).append(lg)
+
+    def sample(self) -> typing.Tuple:
+        """Returns a parameter tuple chosen at random according to the
+        weights, with replacement"""
+        col = random.randrange(len(self.params))
+        if random.random() < self._prob[col]:
+            return self.params[col]
+        return self.params[self._alias[col]]
+
+    def _pass_counts(self) -> typing.List[int]:
+        """Returns how often each tuple is used in one pass through the
+        space. Uniform spaces use every tuple once. Weighted spaces use each
+        tuple in proportion to its weight over 4 times the size of the space
+        (largest remainder rounding), so tuples with a tiny weight may be
+        left out of the pass."""
+        if self._uniform:
+            return [1] * len(self.params)
+        size = self._pass_len
+        exact = [prob * size for prob in self.probabilities]
+        counts = [int(ex) for ex in exact]
+        by_remainder = sorted(range(len(exact)),
+                              key=lambda i: counts[i] - exact[i])
+        for i in by_remainder[:size - sum(counts)]:
+            counts[i] += 1
+        return counts
+
+    def _deck_order(self, rng: random.Random) -> typing.List[int]:
+        """Returns one pass through the space as a shuffled list of indices,
+        see _pass_counts"""
+        order = [i for i, cnt in enumerate(self._pass_counts())
+                 for _ in range(cnt)]
+        rng.shuffle(order)
+        return order
+
+    def draw(self) -> typing.Tuple:
+        """Returns the next parameter tuple of the deck, without replacement
+        until the whole space has been used.
+
+        For seeded cards (see seeding.seed_card) the tuple only depends on
+        the seed and the position of the card in the deck, so no two cards
+        within a pass of the space share a tuple. Otherwise the space is
+        reshuffled after every pass in this process.
+        """
+        card = seeding.current_card()
+        if card is not None:
+            seed, index = card
+            which, pos = divmod(index, self._pass_len)
+            if self._seeded_pass[:2] != (seed, which):
+                rng = random.Random(f'{self.name}:{seed}:{which}')
+                self._seeded_pass = (seed, which, self._deck_order(rng))
+            return self.params[self._seeded_pass[2][pos]]
+
+        if self._pos >= len(self._order):
+            self._order = self._deck_order(random)
+            self._pos = 0
+        self._pos += 1
+        return self.params[self._order[self._pos - 1]]
+
+    def draw_batch(self, n: int, rng) -> typing.List[typing.Tuple]:
+        """Returns n parameter tuples for a batch of cards, without
+        replacement until the whole space has been used like draw, but
+        shuffled with rng rather than the global random state
+
+        Arguments:
+            n (int): the number of tuples
+            rng (numpy.random.Generator): where to draw the shuffles from
+        """
+        import numpy as np  # rng is a numpy generator anyway
+        if self._pass_indices is None:
+            self._pass_indices = np.repeat(np.arange(len(self.params)),
+                                           self._pass_counts())
+        # every pass the batch needs is shuffled at once, one per row
+        passes = -(-n // self._pass_len)
+        order = rng.permuted(np.tile(self._pass_indices, (passes, 1)),
+                             axis=1)
+        return [self.params[i] for i in order.ravel()[:n]]
@@ -0,0 +1,67 @@
+"""Draws graphs as inline pgfplots code, styled like the graphs from
+task_cards.utils.mpl. The curve is sampled with numpy and written into the
+latex as coordinates, so no image is rendered or written to disk and
+matplotlib is never imported.
+"""
+import numpy as np
+
+IMPORTS = {'pgfplots'}
+"""The imports required by graph"""
+
+PREAMBLES = {
+    'pgfgraph': '\n'.join([
+        '\\pgfplotsset{compat=1.16,',
+        '  tcgraph/.style={',
+        '    scale only axis,',
+        '    axis lines=middle,',
+        '    axis line style={-, line width=1.1pt},',
+        '    major tick style={black, line width=0.75pt},',
+        '    major tick length=3pt,',
+        '    tick label style={font=\\scriptsize},',
+        '    clip=true,',
+        '  },',
+        '  tcgraph line/.style={blue, line width=1.5pt, no markers},',
+        '}'
+    ])
+}
+"""The preambles required by graph"""
+
+
+def _ticks(low: int, high: int) -> str:
+    """The integer ticks strictly between low and high, except 0, like the
+    matplotlib graphs"""
+    return ','.join(str(i) for i in range(low + 1, high) if i != 0)
+
+
+def graph(x, y, width: int, height: int, ymin: int,
+          size: str = '155px') -> str:
+    """Returns the pgfplots code for a graph of the given coordinates
+
+    Arguments:
+        x (np.ndarray[samples]): the x-coordinates
+        y (np.ndarray[samples]): the y-coordinates
+        width (int): the left and right edges of the plot
+        height (int): the maximum y of the plot
+        ymin (int): the minimum y of the plot
+        size (str, optional): the width and height of the axes. The default
+            matches the axes of mpl graphs shown by tex.figure_left_of_text
+    """
+    x = np.asarray(x, dtype=np.float64)
+    # points far outside the axes are clipped anyway, but would overflow
+    # the arithmetic of tex; keep them just beyond the edge so the curve
+    # still leaves the plot
+    margin = height - ymin
+    y = np.clip(np.asarray(y, dtype=np.float64),
+                ymin - margin, height + margin)
+    coords = ' '.join(f'({xi:.4g},{yi:.4g})' for xi, yi in zip(x, y))
+
+    return '\n'.join([
+        '\\begin{tikzpicture}',
+        f'\\begin{{axis}}[tcgraph, width={size}, height={size},',
+        f'  xmin={-width}, xmax={width}, ymin={ymin}, ymax={height},',
+        f'  xtick={{{_ticks(-width, width)}}},',
+        f'  ytick={{{_ticks(ymin, height)}}}]',
+        f'\\addplot[tcgraph line] coordinates {{{coords}}};',
+        '\\end{axis}',
+        '\\end{tikzpicture}'
+    ])
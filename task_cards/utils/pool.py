@@ -0,0 +1,20 @@
+"""Helpers for spreading work over pools of workers"""
+import collections
+import concurrent.futures
+import typing
+
+
+def ordered_map(executor: concurrent.futures.Executor,
+                fn: typing.Callable, iterable: typing.Iterable,
+                window: int) -> typing.Iterator:
+    """Like executor.map, but keeps at most window calls in flight so that
+    finished results do not pile up in memory faster than they are
+    consumed, and the iterable is only consumed as results are. Results are
+    yielded in the order of the iterable."""
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,60 @@
+"""Encodes the answers of cards as QR codes in python and draws them as
+vector graphics, so that pdflatex does not have to compute them with the
+macros of the qrcode package, which is slow on large decks. Requires the
+optional qrcode python package.
+"""
+import functools
+import typing
+
+PREAMBLES = {
+    'qrvector': '\\newcommand{\\tcqrrun}[3]'
+                + '{\\put(#1,#2){\\rule{#3\\unitlength}{\\unitlength}}}'
+}
+"""The preambles required by qr_latex"""
+
+SIZE = '2cm'
+"""The default size of the codes, which is that of \\qrcode"""
+
+
+@functools.lru_cache(maxsize=4096)
+def matrix(text: str) -> typing.Tuple[typing.Tuple[bool, ...], ...]:
+    """Returns the modules of the QR code for the text, row by row from
+    the top, True where the module is dark. Uses the same error correction
+    as \\qrcode and no quiet zone."""
+    import qrcode  # optional dependency, only needed for vector codes
+
+    code = qrcode.QRCode(
+        error_correction=qrcode.constants.ERROR_CORRECT_M, border=0)
+    code.add_data(text)
+    code.make(fit=True)
+    return tuple(tuple(row) for row in code.get_matrix())
+
+
+@functools.lru_cache(maxsize=4096)
+def qr_latex(text: str, size: str = SIZE) -> str:
+    """Returns the latex code drawing the QR code for the text. Each run of
+    dark modules in a row is drawn as a single rule.
+
+    Arguments:
+        text (str): what the code encodes
+        size (str, optional): the width and height of the code. Default 2cm
+    """
+    rows = matrix(text)
+    num = len(rows)
+    lines = [
+        f'\\setlength{{\\unitlength}}{{\\dimexpr {size}/{num}\\relax}}%',
+        f'\\begin{{picture}}({num},{num})%'
+    ]
+    for i, row in enumerate(rows):
+        y = num - 1 - i
+        x = 0
+        while x < num:
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < num and row[x]:
+                x += 1
+            lines.append(f'\\tcqrrun{{{start}}}{{{y}}}{{{x - start}}}%')
+    lines.append('\\end{picture}')
+    return '{' + '\n'.join(lines) + '}'  # keeps \unitlength local
@@ -0,0 +1,43 @@
+"""Derives independent random seeds for every card of a deck, so that any
+card can be regenerated on its own, in any process or on any machine,
+and come out the same.
+"""
+import hashlib
+import random
+import sys
+import typing
+
+
+def card_seed(seed: int, page: int, slot: int) -> int:
+    """Returns the seed for the card in the given slot (0-3) of the given
+    page of a deck generated with the given seed"""
+    digest = hashlib.sha256(f'{seed}:{page}:{slot}'.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+_CURRENT_CARD = None
+
+
+def current_card() -> typing.Optional[typing.Tuple[int, int]]:
+    """Returns the seed of the deck and the position in the deck of the
+    card being generated, or None if the deck is not seeded"""
+    return _CURRENT_CARD
+
+
+def seed_card(seed: int, page: int, slot: int):
+    """Seeds the global random generators, which the tasks draw from, for
+    the card in the given slot of the given page. numpy is only seeded if
+    it has been imported, which tasks that use it do at import time."""
+    global _CURRENT_CARD
+    _CURRENT_CARD = (seed, page * 4 + slot)
+    card = card_seed(seed, page, slot)
+    random.seed(card)
+    if 'numpy' in sys.modules:
+        sys.modules['numpy'].random.seed(card % (2 ** 32))
+
+
+def clear():
+    """Forgets the card set by seed_card, for generating unseeded cards
+    in a process which has generated seeded ones"""
+    global _CURRENT_CARD
+    _CURRENT_CARD = None
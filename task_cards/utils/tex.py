@@ -4,7 +4,11 @@ import typing
 import io
 import enum
 import subprocess
+import concurrent.futures
+import hashlib
+import itertools
 import os
+import task_cards.utils.tracing as tracing
 
 
 class TaskStyle(enum.IntEnum):
@@ -12,11 +16,45 @@ class TaskStyle(enum.IntEnum):
     Minimal = 1
 
 
+QR_MODES = ('tex', 'vector')
+"""How the answers are turned into QR codes: 'tex' with \\qrcode, which
+pdflatex computes, or 'vector' drawn from codes computed in python, see
+task_cards.utils.qr"""
+
+_QR_MODE = 'tex'
+
+
+def set_qr_mode(mode: str):
+    """Chooses how the answers are turned into QR codes, see QR_MODES"""
+    global _QR_MODE
+    if mode not in QR_MODES:
+        raise ValueError(f'unknown qr mode {mode}')
+    _QR_MODE = mode
+
+
+def qr_requirements() -> typing.Tuple[typing.Set[str], typing.Dict[str, str]]:
+    """Returns the imports and preambles needed for the QR codes of the
+    answers in the current mode. qrcode loads xcolor, which color relies
+    on, so vector codes import xcolor instead"""
+    if _QR_MODE == 'tex':
+        return {'qrcode'}, dict()
+    import task_cards.utils.qr as qr
+    return {'xcolor'}, dict(qr.PREAMBLES)
+
+
+def qr_code(answer: str) -> str:
+    """Returns the latex code for the QR code of the answer"""
+    if _QR_MODE == 'tex':
+        return f'\\qrcode{{{answer}}}'
+    import task_cards.utils.qr as qr
+    return qr.qr_latex(answer)
+
+
 def generate_doc_latex(
         fp: io.TextIOBase,
         required_imports: typing.Set[str],
         required_preamble: typing.Dict[str, str],
-        pages: typing.List[str]
+        pages: typing.Iterable[str]
         ):
     """
     Creates the latex document that imports the specified documents, has the
@@ -31,18 +69,13 @@ def generate_doc_latex(
         required_preamble (dict[str, str]): the keys are arbitrary identifiers,
             and the values are the latex code that will be included prior to
             beginning the document
-        pages (list[str]): the latex code for each page
+        pages (iterable[str]): the latex code for each page. Pages are
+            written as they are produced, so this may be a generator
     """
     def my_print(*args, **kwargs):
         print(*args, **kwargs, file=fp)
 
-    my_print('\\documentclass[landscape]{article}')
-    my_print('\\usepackage{' + ','.join(required_imports) + '}')
-    my_print()
-    for iden, code in required_preamble.items():
-        my_print(f'% Begin preamble: {iden}')
-        my_print(code)
-        my_print()
+    _generate_doc_preamble(fp, required_imports, required_preamble)
 
     my_print('\\begin{document}')
     for pg_num, pg in enumerate(pages):
@@ -52,6 +85,73 @@ def generate_doc_latex(
     my_print('\\end{document}')
 
 
+def _generate_doc_preamble(
+        fp: io.TextIOBase,
+        required_imports: typing.Set[str],
+        required_preamble: typing.Dict[str, str]
+        ):
+    """Writes everything before begin document. See generate_doc_latex.
+
+    The preamble ends with the marker where mylatexformat stops dumping, so
+    the same preamble can be precompiled by preamble_format. When the
+    document is compiled without the format the marker does nothing.
+    """
+    def my_print(*args, **kwargs):
+        print(*args, **kwargs, file=fp)
+
+    my_print('\\documentclass[landscape]{article}')
+    my_print('\\usepackage{' + ','.join(sorted(required_imports)) + '}')
+    my_print()
+    for iden, code in required_preamble.items():
+        my_print(f'% Begin preamble: {iden}')
+        my_print(code)
+        my_print()
+    my_print('\\csname endofdump\\endcsname')
+
+
+def preamble_format(
+        required_imports: typing.Set[str],
+        required_preamble: typing.Dict[str, str],
+        cache_dir: str = os.path.join('cache', 'formats')
+        ) -> str:
+    """Returns the precompiled pdflatex format for the given imports and
+    preambles, dumping it with mylatexformat if it is not already cached.
+    Documents compiled with the format skip loading their packages. See
+    generate_doc_latex for the arguments.
+
+    Arguments:
+        cache_dir (str, optional): where formats are kept between runs
+    Returns:
+        The path to the format, without the .fmt extension, for pdflatex.
+        Raises RuntimeError if pdflatex fails to dump it
+    """
+    writer = io.StringIO()
+    _generate_doc_preamble(writer, required_imports, required_preamble)
+    preamble = writer.getvalue()
+
+    name = 'preamble_' + hashlib.sha256(
+        preamble.encode('utf-8')).hexdigest()[:16]
+    fmt = os.path.abspath(os.path.join(cache_dir, name))
+    if os.path.exists(fmt + '.fmt'):
+        return fmt
+
+    os.makedirs(cache_dir, exist_ok=True)
+    jobname = f'{name}_{os.getpid()}'  # concurrent dumps do not collide
+    latexfile = os.path.join(cache_dir, jobname + '.tex')
+    with open(latexfile, 'w') as outfile:
+        outfile.write(preamble)
+    result = subprocess.run([
+        'pdflatex', '-ini', f'-jobname={jobname}',
+        '-output-directory', cache_dir, '-interaction=batchmode',
+        '&pdflatex', 'mylatexformat.ltx', latexfile
+    ], stdin=subprocess.DEVNULL)
+    if result.returncode != 0:
+        log = os.path.join(cache_dir, jobname + '.log')
+        raise RuntimeError(f'dumping the format failed, see {log}')
+    os.replace(os.path.join(cache_dir, jobname + '.fmt'), fmt + '.fmt')
+    return fmt
+
+
 def generate_task_minimal(fp: io.TextIOBase, problem_code: str, answer: str,
                           vspace: str = '2cm'):
     """Generates the code for a single task as a minipage given the code
@@ -66,7 +166,7 @@ def generate_task_minimal(fp: io.TextIOBase, problem_code: str, answer: str,
 
     print(problem_code, file=fp, end='\n')
     print(color('.', 'white') + f'\\\\[{vspace}]', file=fp)
-    print(f'\\begin{{center}}\\qrcode{{{answer}}}\\end{{center}}', file=fp)
+    print(f'\\begin{{center}}{qr_code(answer)}\\end{{center}}', file=fp)
 
 
 def generate_task(fp: io.TextIOBase, problem_code: str, answer: str,
@@ -85,19 +185,68 @@ def generate_task(fp: io.TextIOBase, problem_code: str, answer: str,
         raise NotImplementedError
 
 
+CARD_BOXES = ('cardboxa', 'cardboxb', 'cardboxc', 'cardboxd')
+"""The save boxes that hold the 4 cards of a bordered page"""
+
+
+def border_preamble(frame: str,
+                    margins: typing.Tuple[str, str] = ('0.6667in', '0.6667in')
+                    ) -> typing.Dict[str, str]:
+    """Returns the preambles required by bordered pages. The border frame
+    is stored in a save box once, so the image is embedded a single time
+    in the pdf and reused behind every card. Requires the eso-pic and
+    graphicx imports.
+
+    Arguments:
+        frame (str): the border frame image for a quarter of the page. The
+            frame must be in the same directory as the tex file
+        margins (tuple[str, str]): the horizontal and vertical space between
+            the edge of the card and its content. The default matches the
+            200px at 300 DPI used by borders.add_borders_to_img
+    """
+    lines = ['\\newsavebox{\\cardborder}']
+    lines.extend(f'\\newsavebox{{\\{box}}}' for box in CARD_BOXES)
+    lines.extend([
+        '\\newlength{\\cardinnerw}',
+        '\\newlength{\\cardinnerh}',
+        '\\AtBeginDocument{%',
+        '  \\sbox{\\cardborder}{'
+        + figure(frame, '0.5\\paperwidth', '0.5\\paperheight') + '}%',
+        f'  \\setlength{{\\cardinnerw}}'
+        f'{{\\dimexpr0.5\\paperwidth-2\\dimexpr{margins[0]}\\relax\\relax}}%',
+        f'  \\setlength{{\\cardinnerh}}'
+        f'{{\\dimexpr0.5\\paperheight-2\\dimexpr{margins[1]}\\relax\\relax}}%',
+        '}',
+        '\\newcommand{\\cardmarginx}{' + margins[0] + '}',
+        '\\newcommand{\\cardmarginy}{' + margins[1] + '}',
+    ])
+    return {'cardborder': '\n'.join(lines)}
+
+
 def generate_task_page_minimal(
         fp: io.TextIOBase,
-        tasks: typing.Iterable[str]
+        tasks: typing.Iterable[str],
+        bordered: bool = False
         ):
     """Generates one page for the task card, consisting of exactly 4 tasks.
     Minipages are less than 0.5 to make images fit without wrapping to new
     page.
 
+    Bordered pages instead typeset each task in a save box and place it at
+    a fixed position in its quarter of the page, on top of the border from
+    border_preamble and shrunk by its margins, so the text stays vector.
+
     Arguments:
         fp (io.TextIOBase): where to write the problem string
         tasks (iterable[str]): the first string is the problem code and
             the second string is the answer
+        bordered (bool, optional): if the page draws the border saved by
+            border_preamble behind each card. Default False
     """
+    if bordered:
+        _generate_task_page_bordered(fp, tasks)
+        return
+
     for i, task_code in enumerate(tasks):
         if i >= 4:
             raise ValueError(f'too many tasks for page!')
@@ -113,10 +262,43 @@ def generate_task_page_minimal(
     print('\\newpage', file=fp)
 
 
+def _generate_task_page_bordered(fp: io.TextIOBase,
+                                 tasks: typing.Iterable[str]):
+    """See generate_task_page_minimal"""
+    puts = []
+    for i, task_code in enumerate(tasks):
+        if i >= 4:
+            raise ValueError('too many tasks for page!')
+        box = CARD_BOXES[i]
+        print(f'\\begin{{lrbox}}{{\\{box}}}', file=fp)
+        print('\\begin{minipage}[b][0.5\\paperheight][t]{0.5\\paperwidth}',
+              file=fp)
+        print(task_code, file=fp)
+        print('\\end{minipage}', file=fp)
+        print('\\end{lrbox}', file=fp)
+
+        x = '0pt' if (i % 2) == 0 else '0.5\\paperwidth'
+        y = '0.5\\paperheight' if i < 2 else '0pt'
+        puts.append(f'\\put(\\LenToUnit{{{x}}},\\LenToUnit{{{y}}})'
+                    + '{\\usebox{\\cardborder}}%')
+        puts.append('\\put('
+                    + f'\\LenToUnit{{\\dimexpr{x}+\\cardmarginx\\relax}},'
+                    + f'\\LenToUnit{{\\dimexpr{y}+\\cardmarginy\\relax}})'
+                    + '{\\resizebox{\\cardinnerw}{\\cardinnerh}'
+                    + f'{{\\usebox{{\\{box}}}}}}}%')
+
+    print('\\AddToShipoutPictureFG*{\\AtPageLowerLeft{%', file=fp)
+    for put in puts:
+        print(put, file=fp)
+    print('}}', file=fp)
+    print('\\null\\newpage', file=fp)
+
+
 def generate_task_page(
         fp: io.TextIOBase,
         tasks: typing.Iterable[str],
-        style: TaskStyle = TaskStyle.Minimal
+        style: TaskStyle = TaskStyle.Minimal,
+        bordered: bool = False
         ):
     """Generates the given task page according to the style.
 
@@ -125,9 +307,11 @@ def generate_task_page(
         tasks (iterable[str]): the first string is the problem code and
             the second string is the answer
         style (TaskStyle): determine sthe style for the page
+        bordered (bool, optional): if the border from border_preamble is
+            drawn behind each card. Default False
     """
     if style == TaskStyle.Minimal:
-        generate_task_page_minimal(fp, tasks)
+        generate_task_page_minimal(fp, tasks, bordered)
     else:
         raise NotImplementedError
 
@@ -185,19 +369,44 @@ def color(content: str, color: str):
     return f'\\textcolor{{{color}}}{{{content}}}'
 
 
-def figure(fig: str, wid: str, hei: str):
+def figure(fig: str, wid: str, hei: str, shared: bool = False):
     """Returns the latex code to insert the specified figure. The
-    figure must be in the same directory as the tex file"""
-    fig_wo_ext = os.path.splitext(os.path.basename(fig))[0]
+    figure must be in the same directory as the tex file.
+
+    The file is included with its extension, so pdflatex uses the given
+    file type (ex: a vector pdf or a png) rather than searching for one.
+
+    Shared figures are drawn into a global save box the first time they are
+    used and every later use repeats that box, so a figure that appears on
+    many cards is only embedded once in the pdf.
+    """
+    fig_name = os.path.basename(fig)
+
+    code = (f'\\includegraphics[width={wid},height={hei},'
+            + f'keepaspectratio]{{{fig_name}}}')
+    if not shared:
+        return code
+
+    box = f'\\csname tcfig@{fig_name}@{wid}@{hei}\\endcsname'
+    return '\n'.join([
+        f'\\ifcsname tcfig@{fig_name}@{wid}@{hei}\\endcsname\\else',
+        f'\\expandafter\\newsavebox{box}',
+        f'\\global\\expandafter\\setbox{box}=\\hbox{{{code}}}%',
+        '\\fi',
+        f'\\expandafter\\usebox{box}'
+    ])
+
 
-    return (f'\\includegraphics[width={wid},height={hei},'
-            + f'keepaspectratio]{{{fig_wo_ext}}}')
+def figure_left_of_text(fig: str, text: str, shared: bool = False):
+    return left_of_text(figure(fig, '200px', '200px', shared), text)
 
 
-def figure_left_of_text(fig: str, text: str):
+def left_of_text(content: str, text: str):
+    """Returns the latex code placing the content, ex: a figure or a
+    drawing, to the left of the text"""
     return '\n'.join([
         '\\begin{minipage}{0.3\\textwidth}',
-        figure(fig, '200px', '200px'),
+        content,
         '\\end{minipage}',
         '\\hfill',
         '\\begin{minipage}{0.5\\textwidth}',
@@ -215,8 +424,78 @@ def enumer(items: typing.Iterable[str]):
     return '\n'.join(result)
 
 
-def pdflatex(latexfile: str, outdir: str):
-    """Converts the given latex file to pdf"""
-    subprocess.run([
-        'pdflatex', latexfile, '-output-directory', outdir
-    ])
+def pdflatex(latexfile: str, outdir: str, fmt: str = None):
+    """Converts the given latex file to pdf, optionally with a format
+    from preamble_format. pdflatex stops at the first error rather than
+    waiting for input, since several may run at once; raises
+    RuntimeError if it fails"""
+    args = ['pdflatex', '-interaction=nonstopmode', '-halt-on-error',
+            latexfile, '-output-directory', outdir]
+    if fmt is not None:
+        args.insert(1, f'-fmt={fmt}')
+    with tracing.span('pdflatex'):
+        result = subprocess.run(args, stdin=subprocess.DEVNULL)
+    if result.returncode != 0:
+        log = os.path.join(
+            outdir, os.path.splitext(os.path.basename(latexfile))[0] + '.log')
+        raise RuntimeError(f'pdflatex failed on {latexfile}, see {log}')
+
+
+def merge_pdfs(pdfs: typing.Iterable[str], final_pdf: str):
+    """Concatenates the given pdfs in order into final_pdf"""
+    import PyPDF2  # only needed here, and this module is imported by tasks
+
+    with tracing.span('merge pdfs'):
+        merger = PyPDF2.PdfFileMerger()
+        for pdf in pdfs:
+            merger.append(pdf)
+        merger.write(final_pdf)
+        merger.close()
+
+
+def pdflatex_chunked(
+        final_pdf: str,
+        required_imports: typing.Set[str],
+        required_preamble: typing.Dict[str, str],
+        pages: typing.Iterable[str],
+        outdir: str,
+        chunk_size: int = 50,
+        jobs: int = 1,
+        fmt: str = None
+        ):
+    """Splits the pages into documents of at most chunk_size pages which
+    share the same imports and preambles, converts them to pdf with up to
+    jobs concurrent pdflatex processes and merges the results in order.
+    See generate_doc_latex for the arguments.
+
+    Arguments:
+        final_pdf (str): where to write the merged pdf
+        outdir (str): the directory for the chunk documents
+        chunk_size (int, optional): the maximum pages per chunk. Default 50
+        jobs (int, optional): the number of concurrent pdflatex processes.
+            Default 1
+        fmt (str, optional): the format from preamble_format to compile
+            every chunk with
+    """
+    latexfiles = []
+    pages = iter(pages)
+    while True:
+        chunk_pages = list(itertools.islice(pages, chunk_size))
+        if not chunk_pages:
+            break
+        latexfile = os.path.join(outdir, f'chunk_{len(latexfiles)}.tex')
+        with tracing.span('write tex'):
+            with open(latexfile, 'w') as outfile:
+                generate_doc_latex(outfile, required_imports,
+                                   required_preamble, chunk_pages)
+        latexfiles.append(latexfile)
+
+    # pdflatex runs in its own process, so threads are enough here
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(lambda fl: pdflatex(fl, outdir, fmt), latexfiles))
+
+    merge_pdfs(
+        [os.path.join(outdir, os.path.splitext(os.path.basename(fl))[0]
+                      + '.pdf') for fl in latexfiles],
+        final_pdf
+    )
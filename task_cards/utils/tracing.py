@@ -0,0 +1,161 @@
+"""Lightweight tracing of where the time goes when building a deck.
+
+Code marks the interesting parts with span. Tracing is off by default, in
+which case a span does nothing beyond entering a context manager, so the
+spans can stay in place. Once enabled, every span records its wall time,
+its CPU time (of the calling thread plus any child processes it waited on,
+such as pdflatex) and the peak resident memory of the process: how far the
+span raised it, and the high-water mark of the process lifetime when the
+span ended. The high-water mark is not the memory of the span itself,
+since it includes the peaks of everything that ran before.
+
+Each process flushes its spans to its own file in the trace directory, so
+spans from pool workers are collected along with the main process. The
+spans can be written as a Chrome trace (chrome://tracing or Perfetto) and
+summarized as a table.
+"""
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import typing
+
+_EVENTS = None  # the recorded spans, or None when tracing is off
+_TRACE_DIR = None
+_LOCK = threading.Lock()
+
+
+def enable(trace_dir: str):
+    """Turns tracing on for this process and any process it forks
+
+    Arguments:
+        trace_dir (str): where each process writes its spans
+    """
+    global _EVENTS, _TRACE_DIR
+    os.makedirs(trace_dir, exist_ok=True)
+    _EVENTS = []
+    _TRACE_DIR = trace_dir
+
+
+def enabled() -> bool:
+    """Returns if spans are being recorded"""
+    return _EVENTS is not None
+
+
+def _forget_parent_events():
+    if _EVENTS is not None:
+        _EVENTS.clear()
+
+
+os.register_at_fork(after_in_child=_forget_parent_events)
+
+
+def _children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _max_rss() -> int:
+    """The peak resident memory of the process in kilobytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss  # darwin: bytes
+
+
+@contextlib.contextmanager
+def span(name: str, cat: str = 'stage'):
+    """Records the wall time, CPU time and peak memory of the block, see
+    the module docstring
+
+    Arguments:
+        name (str): what is being done, ex: 'pdflatex' or a task name
+        cat (str, optional): groups spans, ex: 'stage' or 'task'
+    """
+    if _EVENTS is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    start_cpu = time.thread_time() + _children_cpu()
+    start_rss = _max_rss()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        cpu = time.thread_time() + _children_cpu() - start_cpu
+        max_rss = _max_rss()
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': {
+                'cpu_ms': cpu * 1e3,
+                'rss_rise_kb': max_rss - start_rss,
+                'max_rss_kb': max_rss
+            }
+        }
+        with _LOCK:
+            _EVENTS.append(event)
+
+
+def flush():
+    """Appends the spans recorded by this process to its file in the trace
+    directory. Pool workers call this after each piece of work, since they
+    are not given a chance to clean up when the pool shuts down."""
+    if not _EVENTS:
+        return
+    with _LOCK:
+        events = list(_EVENTS)
+        _EVENTS.clear()
+    path = os.path.join(_TRACE_DIR, f'{os.getpid()}.jsonl')
+    with open(path, 'a') as outfile:
+        for event in events:
+            print(json.dumps(event), file=outfile)
+
+
+def collect(trace_dir: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Returns the spans every process flushed to the trace directory"""
+    events = []
+    for entry in sorted(os.listdir(trace_dir)):
+        if not entry.endswith('.jsonl'):
+            continue
+        with open(os.path.join(trace_dir, entry), 'r') as infile:
+            events.extend(json.loads(line) for line in infile)
+    return events
+
+
+def write_chrome_trace(events: typing.List[typing.Dict[str, typing.Any]],
+                       path: str):
+    """Writes the spans in the Chrome trace event format"""
+    with open(path, 'w') as outfile:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, outfile)
+
+
+def summary(events: typing.List[typing.Dict[str, typing.Any]]) -> str:
+    """Returns a table of the total wall and CPU time of the spans, the
+    most any of them raised the peak memory of its process and the highest
+    high-water mark of the processes they ran in, grouped by category and
+    name, slowest first"""
+    groups = dict()
+    for event in events:
+        key = (event['cat'], event['name'])
+        count, wall, cpu, rise, rss = groups.get(key, (0, 0.0, 0.0, 0, 0))
+        groups[key] = (count + 1, wall + event['dur'] / 1e6,
+                       cpu + event['args']['cpu_ms'] / 1e3,
+                       max(rise, event['args'].get('rss_rise_kb', 0)),
+                       max(rss, event['args']['max_rss_kb']))
+
+    lines = [f'{"category":<10} {"name":<32} {"count":>7} {"wall s":>10} '
+             + f'{"cpu s":>10} {"rss rise MB":>12} {"process peak MB":>16}']
+    for (cat, name), (count, wall, cpu, rise, rss) in sorted(
+            groups.items(), key=lambda item: -item[1][1]):
+        lines.append(f'{cat:<10} {name:<32} {count:>7} {wall:>10.3f} '
+                     + f'{cpu:>10.3f} {rise / 1024:>12.1f} '
+                     + f'{rss / 1024:>16.1f}')
+    return '\n'.join(lines)
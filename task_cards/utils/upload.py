@@ -1,14 +1,25 @@
 """This package handles uploading images to a server and then returning
 the permalink to the image. This supports one very simple structure of
 a website, but you will generally need to use your own.
+
+Uploads go through an Uploader, which reuses connections, bounds how many
+uploads run at once and retries failed uploads with backoff. Tasks that do
+not want to wait on the network can use deferred, which returns a
+placeholder that the runner swaps for the permalink with resolve once all
+the cards are generated.
 """
 
+import task_cards.utils.tracing as tracing
 import os
 import json
-import requests
 import io
 import typing
-from PIL import Image
+import threading
+import concurrent.futures
+import functools
+import re
+import time
+import uuid
 
 CONFIG_FILE = 'upload.json'
 
@@ -24,26 +35,145 @@ def _config():
             raise ValueError(f'missing key in {CONFIG_FILE}: {key}')
     return res
 
-CONFIG = _config()
 
-def upload(img) -> str:
-    """Returns the permalink to an image after uploading it."""
+@functools.lru_cache(maxsize=None)
+def config() -> typing.Dict[str, str]:
+    """Returns the upload configuration, loading it on first use so that
+    importing this module does not require upload.json"""
+    return _config()
+
+
+def _to_bytes(img) -> bytes:
     if not hasattr(img, 'seek'):
         img_bytes = io.BytesIO()
         img.save(img_bytes, format='PNG')
     else:
         img_bytes = img
     img_bytes.seek(0)
+    return img_bytes.read()
+
+
+class Uploader:
+    """Uploads images to the server, keeping a pooled session per worker
+    thread, running at most max_workers uploads at once and retrying
+    failures with exponential backoff
+    """
+    def __init__(self, upload_url: str, base_url: str, secret: str,
+                 max_workers: int = 4, retries: int = 3,
+                 backoff: float = 0.5, timeout: float = 30):
+        """
+        Arguments:
+            upload_url (str): where images are posted
+            base_url (str): prefixed to the filename the server returns
+            secret (str): sent along with every upload
+            max_workers (int, optional): the maximum number of concurrent
+                uploads. Default 4
+            retries (int, optional): how many times a failed upload is
+                retried. Default 3
+            backoff (float, optional): the seconds to wait before the first
+                retry, doubling for each further retry. Default 0.5
+            timeout (float, optional): the seconds before a request is
+                abandoned. Default 30
+        """
+        self.upload_url = upload_url
+        self.base_url = base_url
+        self.secret = secret
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='upload')
+
+    def _session(self):
+        import requests  # slow to import, so only when uploading
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _post(self, data: bytes) -> str:
+        files = {'file': ('img.png', io.BytesIO(data), 'image/png',
+                          {'Expires': '0'})}
+        with tracing.span('upload', 'upload'):
+            res = self._session().post(self.upload_url,
+                                       data={'secret': self.secret},
+                                       files=files, timeout=self.timeout)
+        res.raise_for_status()
+
+        res_json = res.json()
+        if ('success' not in res_json
+                or not res_json['success']
+                or 'filename' not in res_json):
+            raise ValueError(f'seems like failure response: {res_json}')
+
+        return self.base_url + res_json['filename']
+
+    def _upload_bytes(self, data: bytes) -> str:
+        import requests
+        for attempt in range(self.retries + 1):
+            try:
+                return self._post(data)
+            except (requests.RequestException, ValueError):
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * (2 ** attempt))
+
+    def submit(self, img) -> concurrent.futures.Future:
+        """Starts uploading the image and returns a future for its
+        permalink"""
+        return self._executor.submit(self._upload_bytes, _to_bytes(img))
+
+    def upload(self, img) -> str:
+        """Returns the permalink to an image after uploading it."""
+        return self.submit(img).result()
+
+    def close(self):
+        """Waits for pending uploads and releases the worker threads"""
+        self._executor.shutdown(wait=True)
+
+
+@functools.lru_cache(maxsize=None)
+def default_uploader() -> Uploader:
+    """Returns the process-wide uploader built from the configuration"""
+    cfg = config()
+    return Uploader(cfg['upload_url'], cfg['base_url'], cfg['secret'])
+
+
+def upload(img) -> str:
+    """Returns the permalink to an image after uploading it."""
+    return default_uploader().upload(img)
+
+
+def submit(img) -> concurrent.futures.Future:
+    """Starts uploading the image and returns a future for its permalink"""
+    return default_uploader().submit(img)
+
+
+_PLACEHOLDER_RE = re.compile(r'@@upload:([0-9a-f]{32})@@')
+_PENDING = dict()  # placeholder id -> future
+_PENDING_LOCK = threading.Lock()
+
+
+def deferred(img) -> str:
+    """Starts uploading the image and returns a placeholder which resolve
+    replaces with the permalink. The placeholder is only meaningful in the
+    process that created it."""
+    future = submit(img)
+    iden = uuid.uuid4().hex
+    with _PENDING_LOCK:
+        _PENDING[iden] = future
+    return f'@@upload:{iden}@@'
+
 
-    files = {'file': ('img.png', img_bytes, 'image/png', {'Expires': '0'})}
-    res = requests.post(CONFIG['upload_url'],
-                        data={'secret': CONFIG['secret']},
-                        files=files)
+def resolve(text: str) -> str:
+    """Waits for the uploads referenced by placeholders in the text and
+    replaces them with the permalinks"""
+    if '@@upload:' not in text:
+        return text
 
-    res_json = res.json()
-    if ('success' not in res_json
-            or not res_json['success']
-            or 'filename' not in res_json):
-        raise ValueError(f'seems like failure response: {res_json}')
+    def _replace(match):
+        with _PENDING_LOCK:
+            future = _PENDING.pop(match.group(1))
+        return future.result()
 
-    return CONFIG['base_url'] + res_json['filename']
+    return _PLACEHOLDER_RE.sub(_replace, text)